@@ -0,0 +1,259 @@
+"""
+fetch_all 離線效能測試: 以本地替身取代 FinMind DataLoader / FinMind HTTP、
+MIS getStockInfo.jsp、期交所 P/C 頁面與永豐 snapshots，可設定延遲與失敗率
+
+    python bench_fetch.py [--sizes 300,1000,2000] [--latency sj=0.05,mis=0.08]
+                          [--fail sj=0.2] [--runs 2] [--out <tmp>/bench_output.txt]
+
+每個規模在獨立暫存目錄執行 (冷啟動 + 暖快取)，輸出端到端耗時、
+StageMetrics 各階段耗時與 tracemalloc 記憶體峰值
+"""
+import argparse, os, sys, shutil, tempfile, tracemalloc, threading
+import time as time_module
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import streamlit_app as app
+
+TZ = timezone(timedelta(hours=8))
+LATENCY = {"finmind": 0.05, "finmind_http": 0.08, "mis": 0.08, "taifex": 0.15, "sj": 0.04}
+FAIL = {"finmind": 0.0, "finmind_http": 0.0, "mis": 0.0, "taifex": 0.0, "sj": 0.0}
+
+# ==========================================
+# 測試資料
+# ==========================================
+def make_fixtures(n, today, days=30, seed=7):
+    """
+    n 檔 4 碼普通股 + TAIEX 的 days 個交易日日線 (today 當天尚無盤後資料)
+    以及今日盤中報價、上市/上櫃分類
+    """
+    rng = np.random.RandomState(seed)
+    codes = [str(c) for c in range(1101, 1101 + n)]
+    dates = []
+    d = today - timedelta(days=1)
+    while len(dates) < days:
+        if d.weekday() < 5: dates.append(d.strftime("%Y-%m-%d"))
+        d -= timedelta(days=1)
+    dates = dates[::-1]
+    base = rng.uniform(10, 600, n)
+    steps = rng.normal(0, 0.015, (days + 1, n))
+    px = np.round(base * np.exp(np.cumsum(steps, axis=0)), 2)
+    vol = rng.randint(1_000, 5_000_000, (days, n))
+    market = {}
+    for i, dd in enumerate(dates):
+        market[dd] = pd.DataFrame({
+            "date": dd, "stock_id": codes, "Trading_Volume": vol[i], "Trading_money": (vol[i] * px[i]).astype(np.int64),
+            "open": px[i], "max": px[i], "min": px[i], "close": px[i], "spread": 0.0, "Trading_turnover": vol[i] // 100,
+        })
+    tw = 20000 * np.exp(np.cumsum(rng.normal(0, 0.01, days + 1)))
+    taiex = pd.DataFrame({"date": dates, "stock_id": "TAIEX", "close": np.round(tw[:-1], 2)})
+    live = {c: (float(px[-1][j]), float(px[-2][j])) for j, c in enumerate(codes)}
+    live["t00"] = (float(round(tw[-1], 2)), float(round(tw[-2], 2)))
+    info = pd.DataFrame({"stock_id": codes, "type": np.where(np.arange(n) % 3 == 0, "tpex", "twse"),
+                         "industry_category": [f"產業{j % 20:02d}" for j in range(n)]})
+    return {"codes": codes, "dates": dates, "market": market, "taiex": taiex, "live": live, "info": info}
+
+class Faults:
+    """
+    各來源的延遲 (秒，±20% 抖動) 與失敗機率；另記錄實際呼叫次數
+    """
+    def __init__(self, latency, fail, seed=11):
+        self.latency = dict(LATENCY, **latency); self.fail = dict(FAIL, **fail)
+        self.rng = np.random.RandomState(seed); self.lock = threading.Lock()
+        self.calls = {}
+
+    def hit(self, src, timeout=None):
+        """
+        timeout (秒) 模擬呼叫端的逾時: 延遲超過即等到逾時後拋出 TimeoutError
+        """
+        with self.lock:
+            self.calls[src] = self.calls.get(src, 0) + 1
+            jitter = self.rng.uniform(0.8, 1.2); bad = self.rng.rand() < self.fail[src]
+        lat = self.latency[src] * jitter
+        if timeout is not None and lat > timeout:
+            time_module.sleep(timeout)
+            raise TimeoutError(f"{src} timeout")
+        time_module.sleep(lat)
+        if bad: raise ConnectionError(f"{src} injected failure")
+
+# ==========================================
+# 本地替身
+# ==========================================
+class FakeResponse:
+    def __init__(self, status_code=200, payload=None, text=""):
+        self.status_code = status_code; self.payload = payload; self.text = text
+
+    def json(self):
+        return self.payload
+
+def make_fake_loader(fx, faults):
+    class FakeDataLoader:
+        def login_by_token(self, token): pass
+
+        def taiwan_stock_daily(self, stock_id="", start_date="", end_date=None):
+            faults.hit("finmind")
+            if stock_id == "TAIEX":
+                return fx["taiex"][fx["taiex"]["date"] >= start_date].reset_index(drop=True)
+            if stock_id == "":
+                df = fx["market"].get(start_date)
+                return df.copy() if df is not None else pd.DataFrame()
+            parts = [df[df["stock_id"] == stock_id] for d, df in fx["market"].items() if d >= start_date]
+            return pd.concat(parts, ignore_index=True) if parts else pd.DataFrame()
+
+        def taiwan_stock_info(self):
+            faults.hit("finmind")
+            return fx["info"].copy()
+    return FakeDataLoader
+
+def finmind_http(fx, params):
+    ds, d0 = params.get("dataset"), params.get("start_date", "")
+    dates = [d for d in fx["dates"] if d >= d0]
+    if ds in ("TaiwanFuturesInstitutionalInvestors", "TaiwanFuturesInstitutional"):
+        data = [{"date": d, "institutional_investors": "外資", "long_open_interest_balance_volume": 40000 + i * 500,
+                 "short_open_interest_balance_volume": 30000} for i, d in enumerate(dates)]
+    elif ds == "TaiwanTotalExchangeMarginMaintenance":
+        data = [{"date": d, "TotalExchangeMarginMaintenance": 165.0 + i} for i, d in enumerate(dates)]
+    elif ds == "TaiwanStockTotalMarginPurchaseShortSale":
+        data = [{"date": d, "name": "MarginPurchaseMoney", "TodayBalance": 2.9e11 + i * 1e9} for i, d in enumerate(dates)]
+    else: data = []  # 選擇權留空，走期交所頁面
+    return FakeResponse(200, {"msg": "success", "status": 200, "data": data})
+
+def taifex_html(fx):
+    rows = "".join(f"<tr><td>{d.replace('-', '/')}</td><td>1</td><td>1</td><td>1</td><td>1</td><td>1</td><td>{105 + i}</td></tr>"
+                   for i, d in enumerate(reversed(fx["dates"][-10:])))
+    return ("<table><tr><th>日期</th><th>賣權成交量</th><th>買權成交量</th><th>成交量比</th>"
+            f"<th>賣權未平倉</th><th>買權未平倉</th><th>未平倉比</th></tr>{rows}</table>")
+
+def mis_payload(fx, ex_ch):
+    items = []
+    for q in ex_ch.split("|"):
+        c = q.split("_", 1)[-1].rsplit(".", 1)[0]
+        if c in fx["live"]:
+            z, y = fx["live"][c]
+            items.append({"c": c, "z": f"{z:.2f}", "y": f"{y:.2f}", "pz": "-", "b": "-", "a": "-"})
+    return {"msgArray": items, "rtcode": "0000"}
+
+def make_fake_http(fx, faults):
+    class FakeSession:
+        def __init__(self, impersonate=None): self.headers = {}
+
+        def get(self, url, params=None, timeout=None):
+            faults.hit("mis")
+            if "getStockInfo.jsp" in url: return FakeResponse(200, mis_payload(fx, (params or {}).get("ex_ch", "")))
+            return FakeResponse(200, text="<html></html>")
+
+    def get(url, params=None, **kw):
+        if "finmindtrade" in url:
+            faults.hit("finmind_http")
+            return finmind_http(fx, params or {})
+        return FakeResponse(404)
+
+    def post(url, data=None, json=None, **kw):
+        if "taifex" in url:
+            faults.hit("taifex")
+            return FakeResponse(200, text=taifex_html(fx))
+        return FakeResponse(200, {"ok": True})
+    return SimpleNamespace(Session=FakeSession, get=get, post=post)
+
+class FakeShioaji:
+    def __init__(self, fx, faults):
+        self.fx = fx; self.faults = faults
+        self.Contracts = SimpleNamespace(Stocks={c: SimpleNamespace(code=c) for c in fx["codes"]})
+
+    def usage(self, timeout=5000):
+        return "bench"
+
+    def snapshots(self, contracts, timeout=30000):
+        self.faults.hit("sj", timeout / 1000)
+        out = []
+        for ct in contracts:
+            z, y = self.fx["live"][ct.code]
+            out.append(SimpleNamespace(code=ct.code, close=z, reference_price=y))
+        return out
+
+def frozen_clock(now):
+    class BenchClock(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return now.astimezone(tz) if tz else now.replace(tzinfo=None)
+    return BenchClock
+
+# ==========================================
+# 執行
+# ==========================================
+def install(fx, faults, now):
+    app.finmind = SimpleNamespace(DataLoader=make_fake_loader(fx, faults))
+    app.cffi_requests = make_fake_http(fx, faults)
+    sj_api = FakeShioaji(fx, faults)
+    app.get_api = lambda: (sj_api, None)
+    app.get_finmind_token = lambda: "bench"
+    app.datetime = frozen_clock(now)
+
+def run_size(n, runs, faults_kw, now):
+    fx = make_fixtures(n, now.date())
+    faults = Faults(*faults_kw)
+    install(fx, faults, now)
+    app.FULL_MARKET_MIN = min(app.FULL_MARKET_MIN, n // 2)
+    multi = n > app.TOP_N
+    res = []
+    for i in range(runs):
+        t0 = time_module.perf_counter()
+        data = app.fetch_all(stream=False, multi=multi)
+        res.append((time_module.perf_counter() - t0, data))
+    tracemalloc.start()
+    app.fetch_all(stream=False, multi=multi)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return res, peak, faults.calls
+
+def parse_kv(s):
+    out = {}
+    for part in filter(None, (s or "").split(",")):
+        k, v = part.split("="); out[k.strip()] = float(v)
+    return out
+
+def main():
+    ap = argparse.ArgumentParser(description="fetch_all 離線效能測試")
+    ap.add_argument("--sizes", default="300,1000,2000")
+    ap.add_argument("--runs", type=int, default=2, help="每個規模連續執行次數 (第 1 次為冷啟動)")
+    ap.add_argument("--latency", default="", help="來源延遲秒數，例: sj=0.05,mis=0.1")
+    ap.add_argument("--fail", default="", help="來源失敗率，例: sj=0.2,finmind=0.05")
+    ap.add_argument("--at", default="", help="模擬時間 (YYYY-mm-dd HH:MM，預設最近交易日 10:30)")
+    ap.add_argument("--out", default=os.path.join(tempfile.gettempdir(), "bench_output.txt"))
+    args = ap.parse_args()
+
+    if args.at: now = datetime.strptime(args.at, "%Y-%m-%d %H:%M").replace(tzinfo=TZ)
+    else:
+        now = datetime.now(TZ).replace(hour=10, minute=30, second=0, microsecond=0)
+        while now.weekday() >= 5: now -= timedelta(days=1)
+    faults_kw = (parse_kv(args.latency), parse_kv(args.fail))
+    cwd = os.getcwd(); out_path = os.path.abspath(args.out)
+    lines = [f"fetch_all bench @ {now:%Y-%m-%d %H:%M}  latency={dict(LATENCY, **faults_kw[0])}  fail={dict(FAIL, **faults_kw[1])}"]
+    min0 = app.FULL_MARKET_MIN
+    for n in [int(x) for x in args.sizes.split(",") if x]:
+        work = tempfile.mkdtemp(prefix=f"bench_{n}_")
+        os.chdir(work)
+        app.st.cache_data.clear(); app.st.cache_resource.clear()
+        try: res, peak, calls = run_size(n, args.runs, faults_kw, now)
+        finally:
+            os.chdir(cwd); shutil.rmtree(work, ignore_errors=True)
+            app.FULL_MARKET_MIN = min0
+        lines.append("")
+        lines.append(f"== {n} 檔 | 暖快取記憶體峰值 {peak / 2**20:.1f} MiB | 來源呼叫 {calls}")
+        for i, (sec, data) in enumerate(res):
+            tag = "冷" if i == 0 else "暖"
+            if isinstance(data, str):
+                lines.append(f"  [{tag}] {sec:.2f}s 失敗: {data}"); continue
+            lines.append(f"  [{tag}] {sec:.2f}s  廣度 {data['h']}/{data['v']}  來源 {data['src_type']}")
+            tb = app.StageMetrics.table(data.get("timing"))
+            if not tb.empty: lines += ["      " + l for l in tb.to_string(index=False).splitlines()]
+    text = "\n".join(lines)
+    print(text)
+    with open(out_path, "w", encoding="utf-8") as f: f.write(text + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -2,14 +2,34 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
-from FinMind.data import DataLoader
 from datetime import datetime, timedelta, timezone, time
-import shioaji as sj
-import os, sys, json, subprocess, traceback
-import altair as alt
+import os, sys, json, subprocess, traceback, importlib
 import time as time_module
-import random
 import io 
+import threading, queue, csv, shutil, pickle, gzip, tempfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from collections import deque
+from types import SimpleNamespace
+try: import fcntl
+except ImportError: fcntl = None
+try: import msvcrt
+except ImportError: msvcrt = None
+
+class LazyModule:
+    """
+    第一次取用屬性時才 import；shioaji / FinMind / altair 載入要數秒，首屏用不到
+    """
+    def __init__(self, name):
+        self._name = name; self._mod = None
+
+    def __getattr__(self, attr):
+        if self._mod is None: self._mod = importlib.import_module(self._name)
+        return getattr(self._mod, attr)
+
+sj = LazyModule("shioaji")
+finmind = LazyModule("FinMind.data")
+alt = LazyModule("altair")
 
 # 引入 curl_cffi 
 try:
@@ -28,29 +48,383 @@ BREADTH_LOW = 0.55
 RAPID_THR = 0.03 
 OPEN_DEV_THR = 0.05 
 OPEN_COUNT_THR = 290 
+SWING_THR = 0.05   # 高點回落 / 低點反彈 幅度
+RAPID_WIN = (180, 420)   # 廣度急變的回溯區間 (秒)
 
 EXCL_PFX = ["00", "91"]
-HIST_FILE = "breadth_history_v3.csv"
-RANK_FILE = "ranking_cache.json"
+HIST_FILE = "breadth_history_v3.csv"   # 舊版單檔 (啟動時自動拆分)
+HIST_DIR = "breadth_history"           # 廣度歷史 (每交易日一檔)
+HIST_FULL_DAYS = 10                    # 保留原始解析度的交易日數
+HIST_DOWNSAMPLE_MIN = 5                # 較舊交易日降採樣的分鐘數
+HIST_KEEP_DAYS = 500                   # 超過此交易日數只留收盤一筆 (0 為不縮減)
+RANK_FILE = "ranking_archive.json"        # 成交值排行 (依日期)
+RANK_LEGACY_FILE = "ranking_cache.json"   # 舊版單日排行
+CHART_MAX_PTS = 120                      # 每條曲線送往瀏覽器的點數上限 (LTTB 降採樣)
+CHART_OVERLAY_MAX = 10                   # 最多疊加前幾個交易日
+RANK_KEEP_DAYS = 60                       # 排行檔保留交易日數
+RANK_RETRY_SEC = 3600                     # 排行回補失敗的日子多久後再試
 NOTIFY_FILE = "notify_state.json" 
+OHLC_DIR = "ohlc_store"          # 全市場日線 (每交易日一個 parquet)
+FULL_MARKET_MIN = 1500           # 全市場資料完整的最低筆數
+STORE_READY_T = time(14, 0)      # 盤後資料可寫入的時間
+MIS_WORKERS = 4                  # MIS 同時連線數
+MIS_RATE = 4.0                   # MIS 平均請求數/秒
+MIS_BURST = 4                    # MIS 最大連發數
+MIS_WARM_TTL = 600               # MIS session 重新暖機間隔 (秒)
+SJ_SUB_MAX = 200                 # 永豐即時訂閱上限
+STREAM_MAX_AGE = 900             # 串流報價有效秒數 (冷門股可能久未成交)
+STREAM_REFRESH_SEC = 10          # 串流模式下自動更新間隔
+COLLECT_SEC = 120                # 盤中取樣間隔
+COLLECT_IDLE_SEC = 600           # 盤外取樣間隔
+SNAPSHOT_FILE = "latest_snapshot.pkl"
+COLD_POLL_SEC = 2                # 冷啟動顯示舊快照時，檢查首筆取樣的間隔
+MIN_REFRESH_SEC = 15             # 手動刷新時，此秒數內的快照直接共用
+ROUTE_FILE = "finmind_routes.json"  # FinMind dataset/版本 探測結果
+ROUTE_DEAD_TTL = 86400           # 失效端點暫停嘗試秒數
+ROUTE_DEAD_STATUS = {400, 404, 405, 410, 422}   # 視為端點 / dataset 不存在的 HTTP 狀態
+UNIVERSE_TOPS = [50, 100, 300]   # 多族群廣度的成交值前 N 名
+BACKFILL_WORKERS = 4             # 歷史廣度回補的行程數 (每行程一個年度)
+TG_COALESCE_SEC = 3              # Telegram 合併發送的等待秒數
+TG_TIMEOUT = 10                  # Telegram 單次請求逾時
+TG_RETRIES = 4                   # Telegram 最多嘗試次數
+TG_MAX_LEN = 4000                # Telegram 單則訊息長度上限
+TG_LOG_FILE = "tg_send_log.jsonl"
+KBAR_DIR = "kbar_cache"          # 永豐 1 分 K 快取 (每日一檔)
+KBAR_RATE = 9                    # 分K 查詢次數/秒 (永豐上限約 50 次/5 秒)
+KBAR_WORKERS = 4
+METRICS_FILE = "stage_metrics.jsonl"   # 每次取樣的各階段耗時 (逐行 JSON)
+METRICS_PROM = "stage_metrics.prom"    # 累計計數 (Prometheus textfile 格式)
+REF_DIR = "ref_data"                   # 參考資料 (股票分類 / 永豐合約代號)，每日更新、跨行程共用
+REF_RETRY_SEC = 1800                   # 參考資料下載失敗後的重試間隔
+QUOTE_DEADLINE = 8.0             # 單次報價的整體期限 (秒)
+HEDGE_DELAY = 1.5                # 主來源多久未回齊才對備援來源發出
+SJ_WORKERS = 2                   # 永豐 snapshots 同時請求數
+SJ_RATE = 5                      # 永豐 snapshots 次數/秒
+SJ_CALL_TIMEOUT = 5.0            # 永豐單次 snapshots 逾時 (秒)
+HEALTH_WIN = 20                  # 錯誤率的滾動視窗 (批次數)
+BREAKER_MIN = 4                  # 視窗內至少幾批才判斷跳脫
+BREAKER_ERR = 0.5                # 錯誤率超過此值即跳脫
+BREAKER_COOL = 60                # 跳脫後多久放行一輪試探 (秒)
+TAPE_DIR = "quote_tape"                # 原始回應錄製檔 (TAPE_DIR/<date>/<時間>-<pid>.jsonl.gz)
 
 # ==========================================
 # 基礎函式
 # ==========================================
+@contextmanager
+def file_lock(path):
+    """
+    跨行程互斥 (path + ".lock")；同一行程內的執行緒也會互相等待
+    """
+    f = open(path + ".lock", "a+")
+    try:
+        if fcntl: fcntl.flock(f, fcntl.LOCK_EX)
+        elif msvcrt:
+            f.seek(0)
+            while True:
+                try: msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1); break
+                except OSError: continue
+        yield
+    finally:
+        try:
+            if fcntl: fcntl.flock(f, fcntl.LOCK_UN)
+            elif msvcrt: f.seek(0); msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        except: pass
+        f.close()
+
+class StageMetrics:
+    """
+    取樣流程各階段的耗時、呼叫次數、錯誤與快取命中
+    total 為行程啟動以來累計，run 為本次 fetch_all 的明細
+    """
+    FIELDS = ('calls', 'sec', 'err', 'hit', 'miss')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.total = {}; self.run = {}
+
+    def entry(self, book, name):
+        return book.setdefault(name, dict.fromkeys(self.FIELDS, 0))
+
+    def add(self, name, **kw):
+        with self.lock:
+            for book in (self.total, self.run):
+                e = self.entry(book, name)
+                for k, v in kw.items(): e[k] += v
+
+    @contextmanager
+    def stage(self, name, cached=False):
+        """
+        計時區塊；例外照常拋出但計入錯誤
+        cached=True 時，區塊內沒有回報 miss 即視為快取命中 (st.cache_data 函式用)
+        """
+        with self.lock: miss0 = self.entry(self.total, name)['miss']
+        t0 = time_module.perf_counter(); ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            kw = dict(calls=1, sec=time_module.perf_counter() - t0, err=0 if ok else 1)
+            if cached:
+                with self.lock: kw['hit'] = int(self.entry(self.total, name)['miss'] == miss0)
+            self.add(name, **kw)
+
+    def error(self, name):
+        self.add(name, err=1)
+
+    def cache(self, name, hit, n=1):
+        self.add(name, **({'hit': n} if hit else {'miss': n}))
+
+    def begin(self):
+        with self.lock: self.run = {}
+
+    def end(self, d=""):
+        """
+        結束一次取樣: 逐行 JSON 追加本次明細，並重寫 Prometheus 累計檔
+        """
+        with self.lock:
+            run = {k: dict(v) for k, v in self.run.items()}
+            total = {k: dict(v) for k, v in self.total.items()}
+        try:
+            with open(METRICS_FILE, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({"ts": datetime.now(timezone(timedelta(hours=8))).isoformat(timespec='seconds'),
+                                    "d": d, "stages": run}, ensure_ascii=False) + "\n")
+        except: pass
+        names = {'calls': 'calls_total', 'sec': 'seconds_total', 'err': 'errors_total', 'hit': 'cache_hits_total', 'miss': 'cache_misses_total'}
+        lines = []
+        for k in self.FIELDS:
+            lines.append(f"# TYPE breadth_stage_{names[k]} counter")
+            lines += [f'breadth_stage_{names[k]}{{stage="{n}"}} {e[k]:.6g}' for n, e in sorted(total.items())]
+        try:
+            tmp = METRICS_PROM + ".tmp"
+            with open(tmp, 'w') as f: f.write("\n".join(lines) + "\n")
+            os.replace(tmp, METRICS_PROM)
+        except: pass
+        return run
+
+    @staticmethod
+    def table(run):
+        return pd.DataFrame([{"階段": n, "耗時(s)": round(e['sec'], 3), "呼叫": e['calls'], "錯誤": e['err'],
+                              "命中": e['hit'], "未命中": e['miss']} for n, e in (run or {}).items()])
+
+@st.cache_resource
+def get_metrics():
+    return StageMetrics()
+
+class TapeMiss(Exception):
+    pass
+
+def frame_enc(df):
+    return None if df is None else df.to_dict(orient='split', index=False)
+
+def frame_dec(v):
+    return pd.DataFrame() if v is None else pd.DataFrame(v['data'], columns=v['columns'])
+
+class QuoteTape:
+    """
+    原始回應錄放帶
+    record: MIS / 永豐 snapshots / FinMind (含期交所) 的原始回應連同耗時，逐筆寫入 gzip JSONL
+            每次 fetch_all 開頭記一筆 sample (當時時間)，跨日自動換檔
+    replay: 依 (來源, 參數) 回放同一 sample 內的回應，按錄製耗時 / speed 等待，不連網
+            該 sample 沒有的鍵 (例如錄製時已在快取) 改用帶中最近一次的回應
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.mode = None
+        self.f = None; self.path = None; self.day = None
+        self.samples = []; self.reels = {}; self.latest = {}
+        self.speed = 0.0
+        self.now = None; self.t0 = 0.0
+
+    # ---- 錄製 ----
+    def start_record(self):
+        with self.lock:
+            if self.mode == "record": return
+            self.mode = "record"
+        st.cache_data.clear()   # 第一筆 sample 即包含所有 FinMind 回應
+
+    def stop(self):
+        with self.lock:
+            if self.f: self.f.close()
+            self.f = None; self.path = None; self.day = None; self.mode = None
+
+    def write(self, ev):
+        with self.lock:
+            if self.f is None: return
+            try:
+                self.f.write(json.dumps(ev, ensure_ascii=False, separators=(',', ':'), default=str) + "\n")
+                self.f.flush()
+            except: pass
+
+    def mark(self, now, **flags):
+        """
+        一次取樣的開頭 (flags 為 fetch_all 的參數)；錄製中才寫入
+        """
+        if self.mode != "record": return
+        d = now.strftime("%Y-%m-%d")
+        with self.lock:
+            if d != self.day:
+                if self.f: self.f.close()
+                try:
+                    os.makedirs(os.path.join(TAPE_DIR, d), exist_ok=True)
+                    self.path = os.path.join(TAPE_DIR, d, f"{now:%H%M%S}-{os.getpid()}.jsonl.gz")
+                    self.f = gzip.open(self.path, 'at', encoding='utf-8'); self.day = d
+                except: self.f = None; self.day = None
+        self.write({"ev": "sample", "t": time_module.time(), "now": now.isoformat(), "flags": flags})
+
+    def call(self, src, key, fn, enc=None, dec=None):
+        """
+        經過錄放帶的外部呼叫: 錄製時照常呼叫並記下結果 (或例外)，重播時直接回放
+        """
+        if self.mode == "replay": return self.play(src, key, dec)
+        if self.mode != "record": return fn()
+        t0 = time_module.perf_counter()
+        try: out = fn()
+        except Exception as e:
+            self.write({"ev": "call", "src": src, "key": key, "sec": round(time_module.perf_counter() - t0, 4), "err": str(e)})
+            raise
+        self.write({"ev": "call", "src": src, "key": key, "sec": round(time_module.perf_counter() - t0, 4),
+                    "v": enc(out) if enc else out})
+        return out
+
+    # ---- 重播 ----
+    def load(self, path):
+        """
+        讀入錄製檔 (或目錄下所有錄製檔)，依 sample 分段
+        """
+        files = sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith(".jsonl.gz")) if os.path.isdir(path) else [path]
+        samples, cur = [], None
+        for fn in files:
+            try:
+                with gzip.open(fn, 'rt', encoding='utf-8') as f:
+                    for line in f:
+                        try: ev = json.loads(line)
+                        except ValueError: continue   # 錄製中斷的殘行
+                        if ev.get("ev") == "sample":
+                            cur = {"t": ev["t"], "now": datetime.fromisoformat(ev["now"]), "flags": ev.get("flags", {}), "calls": []}
+                            samples.append(cur)
+                        elif ev.get("ev") == "call" and cur is not None:
+                            cur["calls"].append(ev)
+            except (EOFError, gzip.BadGzipFile, OSError):
+                pass   # 錄製行程被中止: 檔尾不完整，保留已讀到的部分 (每筆寫入後都有 flush)
+        samples.sort(key=lambda s: s["t"])   # 同日多個行程的錄製檔依時間交錯
+        self.samples = samples
+        return samples
+
+    def cue(self, i):
+        """
+        切換到第 i 個 sample: 之前 sample 的回應併入「最近一次」備援表
+        """
+        for s in self.samples[:i]:
+            if s.get("merged"): continue
+            for ev in s["calls"]: self.latest[(ev["src"], ev["key"])] = ev
+            s["merged"] = True
+        reels = {}
+        for ev in self.samples[i]["calls"]: reels.setdefault((ev["src"], ev["key"]), deque()).append(ev)
+        with self.lock:
+            self.mode = "replay"; self.reels = reels
+            self.now = self.samples[i]["now"]; self.t0 = time_module.monotonic()
+
+    def keys(self, src):
+        return {ev["key"] for s in self.samples for ev in s["calls"] if ev["src"] == src}
+
+    def clock(self):
+        return self.now + timedelta(seconds=time_module.monotonic() - self.t0)
+
+    def play(self, src, key, dec):
+        with self.lock:
+            reel = self.reels.get((src, key))
+            if reel: ev = reel.popleft() if len(reel) > 1 else reel[0]
+            else: ev = self.latest.get((src, key))
+        if ev is None: raise TapeMiss(f"{src} {key}")
+        if self.speed > 0: time_module.sleep(ev.get("sec", 0) / self.speed)
+        if "err" in ev: raise ConnectionError(ev["err"])
+        return dec(ev["v"]) if dec else ev["v"]
+
+@st.cache_resource
+def get_tape():
+    return QuoteTape()
+
+def finmind_fetch(token, method, **kw):
+    """
+    FinMind DataLoader 呼叫 (經過錄放帶)
+    """
+    def call():
+        api = finmind.DataLoader()
+        if token: api.login_by_token(token)
+        return getattr(api, method)(**kw)
+    return get_tape().call("finmind", f"{method}:{json.dumps(kw, sort_keys=True)}", call, frame_enc, frame_dec)
+
 def get_finmind_token():
     try:
         return st.secrets["finmind"]["token"]
     except:
         return None
 
+class TgDispatcher(threading.Thread):
+    """
+    Telegram 背景發送: 短時間內的多則訊息合併為一則，逾時重試 (指數退避)，
+    每次發送結果寫入 TG_LOG_FILE
+    """
+    def __init__(self):
+        super().__init__(daemon=True, name="tg-dispatcher")
+        self.q = queue.Queue()
+
+    def put(self, token, chat_id, msg):
+        self.q.put((token, chat_id, msg))
+
+    def run(self):
+        while True:
+            batch = [self.q.get()]
+            deadline = time_module.monotonic() + TG_COALESCE_SEC
+            while True:
+                left = deadline - time_module.monotonic()
+                if left <= 0: break
+                try: batch.append(self.q.get(timeout=left))
+                except queue.Empty: break
+            merged = {}
+            for token, chat_id, msg in batch:
+                merged.setdefault((token, chat_id), []).append(msg)
+            for (token, chat_id), msgs in merged.items():
+                text = "\n\n".join(msgs)
+                for i in range(0, len(text), TG_MAX_LEN):
+                    self.deliver(token, chat_id, text[i:i+TG_MAX_LEN], len(msgs))
+
+    def deliver(self, token, chat_id, text, n_msgs):
+        url = f"https://api.telegram.org/bot{token}/sendMessage"
+        err, ok, attempt = "", False, 0
+        for attempt in range(1, TG_RETRIES + 1):
+            wait = 2 ** (attempt - 1)
+            try:
+                r = cffi_requests.post(url, json={"chat_id": chat_id, "text": text, "parse_mode": "HTML"}, impersonate="chrome", timeout=TG_TIMEOUT)
+                if r.status_code == 200: ok = True; break
+                err = f"HTTP {r.status_code}"
+                if r.status_code == 429:
+                    try: wait = int(r.json().get("parameters", {}).get("retry_after", wait))
+                    except: pass
+                elif 400 <= r.status_code < 500: break
+            except Exception as e: err = str(e)
+            if attempt < TG_RETRIES: time_module.sleep(wait)
+        try:
+            with open(TG_LOG_FILE, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({"ts": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "chat": chat_id, "ok": ok,
+                                    "tries": attempt, "merged": n_msgs, "err": err, "text": text[:200]}, ensure_ascii=False) + "\n")
+        except: pass
+
+@st.cache_resource
+def get_tg_dispatcher():
+    d = TgDispatcher()
+    d.start()
+    return d
+
 def send_tg(token, chat_id, msg):
+    """
+    排入背景發送佇列後立即返回；chat_id 可用逗號分隔多個
+    """
     if not token or not chat_id: return False
-    try:
-        url = f"https://api.telegram.org/bot{token}/sendMessage"
-        r = cffi_requests.post(url, json={"chat_id": chat_id, "text": msg, "parse_mode": "HTML"}, impersonate="chrome")
-        return r.status_code == 200
-    except:
-        return False
+    disp = get_tg_dispatcher()
+    for cid in str(chat_id).split(","):
+        if cid.strip(): disp.put(token, cid.strip(), msg)
+    return True
 
 def load_notify_state(today_str):
     default_state = {
@@ -61,7 +435,10 @@ def load_notify_state(today_str):
         "was_dev_low": False,
         "notified_drop_high": False,
         "notified_rise_low": False,
-        "intraday_trend": None  
+        "intraday_trend": None,
+        # 規則引擎的滾動狀態
+        "open_b": None, "max_b": None, "min_b": None,
+        "win": [], "last_key": ""
     }
     
     if not os.path.exists(NOTIFY_FILE):
@@ -72,114 +449,570 @@ def load_notify_state(today_str):
             state = json.load(f)
             if state.get("date") != today_str:
                 return default_state
-            if "intraday_trend" not in state:
-                state["intraday_trend"] = None
+            for k, v in default_state.items(): state.setdefault(k, v)
             return state
     except:
         return default_state
 
 def save_notify_state(state):
     try:
-        with open(NOTIFY_FILE, 'w') as f:
+        tmp = NOTIFY_FILE + ".tmp"
+        with open(tmp, 'w') as f:
             json.dump(state, f)
+        os.replace(tmp, NOTIFY_FILE)
     except:
         pass
 
-def check_rapid(row):
+# ==========================================
+# 警示規則 (宣告式，逐筆增量評估)
+# ==========================================
+# kind:
+#   edge   條件成立且 flag 為 False 時觸發並設 flag；rearm=True 則條件不成立時重置 flag
+#   change 值改變時觸發 (key 存上一次的值)
+#   event  每筆條件成立皆觸發，以 dedupe 值去重 (key 存上一次的值)
+# active: 規則的前提 (不成立時整條規則略過，flag 不動)
+# msg:    回傳空字串表示只更新狀態不發送
+def temperature(c):
+    return 'hot' if c['br'] >= BREADTH_THR else ('cold' if c['br'] <= BREADTH_LOW else 'normal')
+
+ALERT_RULES = [
+    {"id": "trend_up", "kind": "edge", "flag": None,
+     "when": lambda c, s: s['intraday_trend'] is None and c['open'] is not None and c['br'] >= c['open'] + OPEN_DEV_THR,
+     "then": lambda c, s: s.update(intraday_trend='up'),
+     "msg": lambda c, s: f"🔒 <b>【趨勢鎖定】</b>\n廣度先達開盤+{OPEN_DEV_THR:.0%} (目前{c['br']:.1%})，今日確認偏多！"},
+    {"id": "trend_down", "kind": "edge", "flag": None,
+     "when": lambda c, s: s['intraday_trend'] is None and c['open'] is not None and c['br'] <= c['open'] - OPEN_DEV_THR,
+     "then": lambda c, s: s.update(intraday_trend='down'),
+     "msg": lambda c, s: f"🔒 <b>【趨勢鎖定】</b>\n廣度先達開盤-{OPEN_DEV_THR:.0%} (目前{c['br']:.1%})，今日確認偏空！"},
+    {"id": "temperature", "kind": "change", "key": "last_stt",
+     "value": lambda c, s: temperature(c),
+     "msg": lambda c, s: {"hot": f"🔥 過熱: {c['br']:.1%}", "cold": f"❄️ 冰點: {c['br']:.1%}"}.get(temperature(c), "")},
+    {"id": "rapid", "kind": "event", "key": "last_rap",
+     "when": lambda c, s: c['rap'] is not None and abs(c['br'] - c['rap'][1]) >= RAPID_THR,
+     "dedupe": lambda c, s: str(c['dt']),
+     "msg": lambda c, s: (f"⚡ <b>【廣度急變】</b>\n{c['rap'][0][11:16]} ({c['rap'][1]:.1%}) ➜ {c['time']} ({c['br']:.1%})\n"
+                          f"{int(c['rap'][2] // 60)}分鐘內{'上漲' if c['br'] > c['rap'][1] else '下跌'} {abs(c['br'] - c['rap'][1]):.1%}")},
+    {"id": "dev_high", "kind": "edge", "flag": "was_dev_high", "rearm": False,
+     "active": lambda c, s: c['open'] is not None,
+     "when": lambda c, s: c['br'] >= c['open'] + OPEN_DEV_THR, "msg": lambda c, s: ""},
+    {"id": "dev_low", "kind": "edge", "flag": "was_dev_low", "rearm": False,
+     "active": lambda c, s: c['open'] is not None,
+     "when": lambda c, s: c['br'] <= c['open'] - OPEN_DEV_THR, "msg": lambda c, s: ""},
+    {"id": "drop_high", "kind": "edge", "flag": "notified_drop_high", "rearm": True,
+     "active": lambda c, s: c['open'] is not None,
+     "when": lambda c, s: c['br'] <= c['max'] - SWING_THR,
+     "msg": lambda c, s: f"📉 <b>【高點回落】</b>\n今日高點: {c['max']:.1%}\n目前廣度: {c['br']:.1%}\n已回檔 {SWING_THR:.0%}"
+                         if s['intraday_trend'] == 'up' and c['slope'] != 0 else ""},
+    {"id": "rise_low", "kind": "edge", "flag": "notified_rise_low", "rearm": True,
+     "active": lambda c, s: c['open'] is not None,
+     "when": lambda c, s: c['br'] >= c['min'] + SWING_THR,
+     "msg": lambda c, s: f"🚀 <b>【低點反彈】</b>\n今日低點: {c['min']:.1%}\n目前廣度: {c['br']:.1%}\n已反彈 {SWING_THR:.0%}"
+                         if s['intraday_trend'] == 'down' and c['slope'] != 0 else ""},
+]
+
+def step_alerts(state, sample):
     """
-    檢查廣度急變
+    以一筆新樣本更新滾動狀態 (開盤/高/低/急變視窗) 並評估所有規則，回傳要發送的訊息
+    同一筆樣本 (日期+時間+廣度相同) 不重複評估；盤外或無有效檔數的樣本略過
     """
-    if not os.path.exists(HIST_FILE): return None, None
-    try:
-        df = pd.read_csv(HIST_FILE)
-        if len(df) < 2: return None, None
-        curr_dt = datetime.strptime(f"{row['Date']} {row['Time']}", "%Y-%m-%d %H:%M")
-        curr_v = float(row['Breadth'])
-        target = None
-        
-        for i in range(2, min(15, len(df)+1)):
-            r = df.iloc[-i]
-            try: 
-                r_t = r['Time'] if len(str(r['Time']))==5 else r['Time'][:5]
-            except: continue
-            
-            r_dt = datetime.strptime(f"{r['Date']} {r_t}", "%Y-%m-%d %H:%M")
-            seconds_diff = (curr_dt - r_dt).total_seconds()
-            
-            if 180 <= seconds_diff <= 420:
-                target = r; break
-                
-        if target is not None:
-            prev_v = float(target['Breadth'])
-            diff = curr_v - prev_v
-            
-            if abs(diff) >= RAPID_THR:
-                d_str = "上漲" if diff > 0 else "下跌"
-                time_diff_min = int(seconds_diff // 60)
-                msg = f"⚡ <b>【廣度急變】</b>\n{target['Time'][:5]} ({prev_v:.1%}) ➜ {row['Time']} ({curr_v:.1%})\n{time_diff_min}分鐘內{d_str} {abs(diff):.1%}"
-                return msg, str(curr_dt)
-    except: pass
-    return None, None
+    t = str(sample['Time'])[:5]
+    if not ("09:00" <= t <= "13:30") or not sample.get('Total', 0): return []
+    key = f"{sample['Date']} {t} {sample['Breadth']:.6f}"
+    if key == state['last_key']: return []
+    state['last_key'] = key
+    br = float(sample['Breadth'])
+    dt = datetime.strptime(f"{sample['Date']} {t}", "%Y-%m-%d %H:%M")
+
+    if state['open_b'] is None and t >= "09:00" and sample.get('Total', 0) >= OPEN_COUNT_THR:
+        state['open_b'] = br
+    state['max_b'] = br if state['max_b'] is None else max(state['max_b'], br)
+    state['min_b'] = br if state['min_b'] is None else min(state['min_b'], br)
+
+    # 急變視窗: 只保留 RAPID_WIN 秒內的樣本，取 3~7 分鐘前最新的一筆
+    win = [w for w in state['win'] if 0 <= (dt - datetime.strptime(w[0], "%Y-%m-%d %H:%M")).total_seconds() <= RAPID_WIN[1]]
+    rap = None
+    for w_t, w_b in reversed(win):
+        diff = (dt - datetime.strptime(w_t, "%Y-%m-%d %H:%M")).total_seconds()
+        if RAPID_WIN[0] <= diff <= RAPID_WIN[1]: rap = (w_t, w_b, diff); break
+    state['win'] = win + [[dt.strftime("%Y-%m-%d %H:%M"), br]]
+
+    c = {"br": br, "dt": dt, "time": t, "open": state['open_b'], "max": state['max_b'], "min": state['min_b'],
+         "slope": sample.get('slope', 0), "rap": rap}
+    out = []
+    for r in ALERT_RULES:
+        if 'active' in r and not r['active'](c, state): continue
+        msg = None
+        if r['kind'] == 'edge':
+            hit = r['when'](c, state)
+            flag = r.get('flag')
+            if hit and not (flag and state.get(flag)):
+                msg = r['msg'](c, state)
+                if flag: state[flag] = True
+                if 'then' in r: r['then'](c, state)
+            elif not hit and flag and r.get('rearm'):
+                state[flag] = False
+        elif r['kind'] == 'change':
+            v = r['value'](c, state)
+            if v != state.get(r['key']): msg = r['msg'](c, state)
+            state[r['key']] = v
+        elif r['kind'] == 'event':
+            if r['when'](c, state):
+                d = r['dedupe'](c, state)
+                if d != state.get(r['key']):
+                    msg = r['msg'](c, state); state[r['key']] = d
+        if msg: out.append(msg)
+    return out
+
+def process_alerts(data, tg_tok, tg_id):
+    """
+    取樣後呼叫: 更新並原子寫入通知狀態，有設定 TG 才發送
+    """
+    with file_lock(NOTIFY_FILE):
+        state = load_notify_state(data['d'])
+        if state['max_b'] is None:
+            state['open_b'] = get_opening_breadth(data['d'])
+            state['max_b'], state['min_b'] = get_intraday_extremes(data['d'])
+        sample = dict(data['raw'], Total=data['v'], slope=data['slope'])
+        msgs = step_alerts(state, sample)
+        save_notify_state(state)
+    if tg_tok and tg_id:
+        for m in msgs: send_tg(tg_tok, tg_id, m)
+    return state
+
+HIST_COLS = ['Date', 'Time', 'Breadth', 'Taiex_Change', 'Taiex_Current', 'Taiex_Prev_Close', 'Total']
+
+def new_day():
+    return {'rows': [], 'max': None, 'min': None, 'open_t': None, 'open_b': None, 'size': 0, 'ino': None}
+
+def index_row(day, row):
+    d = str(row['Date']); t = str(row['Time'])[:5]
+    row['Date'] = d; row['Time'] = t
+    for k in ('Breadth', 'Taiex_Change', 'Taiex_Current', 'Taiex_Prev_Close'):
+        row[k] = float(row.get(k) or 0)
+    row['Total'] = int(float(row.get('Total') or 0))
+    day['rows'].append(row)
+    b = row['Breadth']
+    if t < "09:00" or row['Total'] == 0: return   # 試撮/無有效檔數的列不計入當日極值與開盤
+    day['max'] = b if day['max'] is None else max(day['max'], b)
+    day['min'] = b if day['min'] is None else min(day['min'], b)
+    if row['Total'] >= OPEN_COUNT_THR and (day['open_t'] is None or t < day['open_t']):
+        day['open_t'] = t; day['open_b'] = b
+
+def downsample_rows(rows, minutes):
+    """
+    降採樣: 每 N 分鐘保留最後一筆，另保留開盤基準那一筆
+    """
+    day = new_day()
+    for r in rows: index_row(day, dict(r))
+    keep = {}
+    for i, r in enumerate(day['rows']):
+        hh, mm = r['Time'][:2], r['Time'][3:5]
+        try: bucket = int(hh) * 60 + int(mm) // minutes * minutes
+        except: continue
+        keep[bucket] = i
+    idx = set(keep.values())
+    if day['open_t'] is not None:
+        idx.add(next(i for i, r in enumerate(day['rows']) if r['Time'] == day['open_t']))
+    return [day['rows'][i] for i in sorted(idx)]
+
+def lttb(x, y, n):
+    """
+    Largest-Triangle-Three-Buckets 降採樣，回傳保留點的索引 (首尾必留)
+    """
+    m = len(x)
+    if n >= m or n < 3: return np.arange(m)
+    edges = np.linspace(1, m - 1, n - 1).astype(int)
+    idx = np.empty(n, dtype=int); idx[0] = 0; idx[-1] = m - 1
+    a = 0
+    for i in range(n - 2):
+        lo, hi = edges[i], max(edges[i + 1], edges[i] + 1)
+        if i + 2 < n - 1: nlo, nhi = hi, max(edges[i + 2], hi + 1)
+        else: nlo, nhi = m - 1, m
+        ax, ay = x[nlo:nhi].mean(), y[nlo:nhi].mean()
+        area = np.abs((x[a] - ax) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (ay - y[a]))
+        a = lo + int(np.argmax(area)) if len(area) else lo
+        idx[i + 1] = a
+    return idx
+
+def new_series():
+    return {'n': 0, 'x': [], 'b': [], 'c': [], 'out': None}
+
+def series_extend(ser, rows):
+    """
+    圖表曲線只解析 ser['n'] 之後新增的列 (09:00 前的略過)
+    """
+    for r in rows[ser['n']:]:
+        t = str(r['Time'])
+        if t < "09:00": continue
+        try: ser['x'].append(int(t[:2]) * 60 + int(t[3:5]))
+        except: continue
+        ser['b'].append(float(r['Breadth'])); ser['c'].append(float(r['Taiex_Change']))
+    ser['n'] = len(rows)
+
+def series_frame(ser, d, n=CHART_MAX_PTS):
+    """
+    累積的曲線 ➜ LTTB 降到 n 點的 DataFrame (Min 為當日分鐘數，疊圖時換算到基準日)
+    """
+    x = np.asarray(ser['x'], dtype=float); b = np.asarray(ser['b'], dtype=float); c = np.asarray(ser['c'], dtype=float)
+    order = np.argsort(x, kind='stable')
+    x, b, c = x[order], b[order], c[order]
+    keep = lttb(x, np.nan_to_num(b), n)
+    return pd.DataFrame({'Date': d, 'Min': x[keep], 'Breadth': b[keep], 'Taiex_Change': c[keep]})
+
+class BreadthHistory:
+    """
+    常駐記憶體的廣度歷史，依交易日分檔 (HIST_DIR/<date>.csv，只追加)
+    開盤廣度、盤中極值隨寫入即時更新
+    讀取當日只會碰當日的分檔，過去的分檔在需要時才載入
+    """
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.RLock()
+        self.days = {}
+        self.date_list = None
+
+    def part(self, d):
+        return os.path.join(self.root, f"{d}.csv")
+
+    def dates(self):
+        today = datetime.now(timezone(timedelta(hours=8))).strftime("%Y-%m-%d")
+        if self.date_list is None or (self.date_list[-1:] != [today] and os.path.exists(self.part(today))):
+            try: self.date_list = sorted(f[:-4] for f in os.listdir(self.root) if f.endswith(".csv"))
+            except: self.date_list = []
+        return self.date_list
+
+    def load_day(self, d):
+        day = new_day()
+        path = self.part(d)
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    for row in csv.DictReader(f): index_row(day, row)
+                st_ = os.stat(path); day['size'] = st_.st_size; day['ino'] = st_.st_ino
+            except: pass
+        return day
+
+    def ensure(self, d):
+        """
+        取得單日索引；分檔被其他行程追加時只解析新增的部分
+        """
+        d = str(d)
+        with self.lock:
+            path = self.part(d)
+            st_ = os.stat(path) if os.path.exists(path) else None
+            day = self.days.get(d)
+            if st_ is None:
+                if day is not None and day['size'] > 0:
+                    self.days.pop(d, None); self.date_list = None
+                return self.days.get(d)
+            if day is not None and st_.st_size == day['size'] and st_.st_ino == day['ino']: return day
+            if day is None or st_.st_size < day['size'] or st_.st_ino != day['ino']:
+                day = self.load_day(d)
+            else:
+                try:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        f.seek(day['size'])
+                        for vals in csv.reader(f.read().splitlines()):
+                            if len(vals) == len(HIST_COLS): index_row(day, dict(zip(HIST_COLS, vals)))
+                    day['size'] = st_.st_size
+                except: day = self.load_day(d)
+            self.days[d] = day
+            if d not in self.dates(): self.date_list = None
+            return day
+
+    def write_day(self, d, rows):
+        tmp = self.part(d) + ".tmp"
+        with open(tmp, 'w', newline='', encoding='utf-8') as f:
+            w = csv.writer(f); w.writerow(HIST_COLS)
+            for r in rows: w.writerow([r[k] for k in HIST_COLS])
+        os.replace(tmp, self.part(d))
+        self.days.pop(d, None)
+
+    def append(self, row):
+        d = str(row['Date'])
+        with self.lock:
+            os.makedirs(self.root, exist_ok=True)
+            path = self.part(d)
+            new_file = not os.path.exists(path)
+            with open(path, 'a', newline='', encoding='utf-8') as f:
+                w = csv.writer(f)
+                if new_file: w.writerow(HIST_COLS)
+                w.writerow([row[k] for k in HIST_COLS])
+            if new_file:
+                self.date_list = None
+                self.compact()
+            self.ensure(d)
+
+    def put_close(self, d, row):
+        """
+        盤後寫入收盤列: 盤中資料保留，只覆蓋收盤時間 (含) 之後的列 (內容相同時不重寫檔案)
+        """
+        with self.lock:
+            day = self.ensure(d)
+            rows = day['rows'] if day else []
+            tail = [r for r in rows if r['Time'] >= row['Time']]
+            if len(tail) == 1 and tail[0]['Time'] == row['Time'] and all(float(tail[0][k]) == float(row[k]) for k in HIST_COLS[2:]): return
+            if not tail: self.append(row)
+            else: self.write_day(str(d), [r for r in rows if r['Time'] < row['Time']] + [row])
+
+    def compact(self):
+        """
+        保留政策: 近 HIST_FULL_DAYS 個交易日為原始解析度，較舊的降為
+        HIST_DOWNSAMPLE_MIN 分鐘，超過 HIST_KEEP_DAYS 個交易日的只留收盤一筆 (0 為不縮減)
+        """
+        dates = self.dates()
+        meta_path = os.path.join(self.root, "meta.json")
+        try:
+            with open(meta_path, 'r') as f: meta = json.load(f)
+        except: meta = {}
+        done, eod_done = meta.get("downsampled", ""), meta.get("eod", "")
+        eod = [d for d in dates[:-HIST_KEEP_DAYS] if d > eod_done] if HIST_KEEP_DAYS > 0 and len(dates) > HIST_KEEP_DAYS else []
+        for d in eod:
+            rows = self.load_day(d)['rows']
+            if len(rows) > 1: self.write_day(d, rows[-1:])
+        old = [d for d in dates[:-HIST_FULL_DAYS] if d > done] if len(dates) > HIST_FULL_DAYS else []
+        for d in old:
+            if d in eod: continue
+            self.write_day(d, downsample_rows(self.load_day(d)['rows'], HIST_DOWNSAMPLE_MIN))
+        if old or eod:
+            if old: meta["downsampled"] = old[-1]
+            if eod: meta["eod"] = eod[-1]
+            try:
+                with open(meta_path, 'w') as f: json.dump(meta, f)
+            except: pass
+
+    def migrate(self, legacy):
+        """
+        舊版單一 CSV 拆成每日分檔 (只做一次，舊檔改名保留)
+        """
+        if not os.path.exists(legacy) or os.path.isdir(self.root): return
+        try:
+            df = pd.read_csv(legacy, dtype={'Date': str, 'Time': str})
+            if 'Total' not in df.columns: df['Total'] = 0
+            os.makedirs(self.root, exist_ok=True)
+            for d, g in df.groupby('Date', sort=True):
+                day = new_day()
+                for row in g[HIST_COLS].to_dict('records'): index_row(day, row)
+                self.write_day(str(d), day['rows'])
+            os.replace(legacy, legacy + ".bak")
+            self.date_list = None
+            self.compact()
+        except: pass
+
+    def clear(self):
+        with self.lock:
+            shutil.rmtree(self.root, ignore_errors=True)
+            self.days = {}; self.date_list = None
+
+    def last(self):
+        dates = self.dates()
+        if not dates: return None
+        day = self.ensure(dates[-1])
+        return day['rows'][-1] if day and day['rows'] else None
+
+    def opening(self, d):
+        day = self.ensure(d)
+        return day['open_b'] if day else None
+
+    def extremes(self, d):
+        day = self.ensure(d)
+        return (day['max'], day['min']) if day else (None, None)
+
+    def sessions(self, before=None, k=1):
+        """
+        最近 k 個有 09:00 後資料的交易日 (由新到舊)，before 指定時只取更早的
+        """
+        out = []
+        for dd in reversed(self.dates()):
+            if len(out) >= k: break
+            if before and dd >= before: continue
+            day = self.ensure(dd)
+            if day and any(r['Time'] >= "09:00" for r in day['rows']): out.append(dd)
+        return out
+
+    def series(self, d, n=CHART_MAX_PTS):
+        """
+        單日圖表曲線；逐日快取，分檔有新列時只追加新點，降採樣結果在資料不變時重用
+        """
+        with self.lock:
+            day = self.ensure(d)
+            if not day: return None
+            ser = day.setdefault('series', new_series())
+            if ser['n'] != len(day['rows']) or ser['out'] is None or ser['out'][0] != n:
+                series_extend(ser, day['rows'])
+                ser['out'] = (n, series_frame(ser, d, n))
+            return ser['out'][1]
+
+@st.cache_resource
+def get_history():
+    h = BreadthHistory(HIST_DIR)
+    h.migrate(HIST_FILE)
+    return h
 
 def get_opening_breadth(d_cur):
-    if not os.path.exists(HIST_FILE): return None
     try:
-        df = pd.read_csv(HIST_FILE)
-        if df.empty: return None
-        if 'Total' not in df.columns: df['Total'] = 0
-    
-        df['Date'] = df['Date'].astype(str)
-        df_today = df[df['Date'] == str(d_cur)].copy()
-        if df_today.empty: return None
-        
-        df_today = df_today[df_today['Time'] >= "09:00"]
-        df_valid = df_today[df_today['Total'] >= OPEN_COUNT_THR].sort_values('Time')
-        
-        if not df_valid.empty:
-            return float(df_valid.iloc[0]['Breadth'])
-    except: pass
-    return None
+        hist = get_history()
+        return hist.opening(d_cur)
+    except: return None
 
 def get_intraday_extremes(d_cur):
-    if not os.path.exists(HIST_FILE): return None, None
     try:
-        df = pd.read_csv(HIST_FILE)
-        if df.empty: return None, None
-        df['Date'] = df['Date'].astype(str)
-        df_today = df[df['Date'] == str(d_cur)]
-        if df_today.empty: return None, None
-        return df_today['Breadth'].max(), df_today['Breadth'].min()
+        hist = get_history()
+        return hist.extremes(d_cur)
     except: return None, None
 
 @st.cache_resource(ttl=3600) 
 def get_api():
     api = sj.Shioaji(simulation=False)
     try: 
-        api.login(api_key=st.secrets["shioaji"]["api_key"], secret_key=st.secrets["shioaji"]["secret_key"])
-        api.fetch_contracts(contract_download=True)
+        api.login(api_key=st.secrets["shioaji"]["api_key"], secret_key=st.secrets["shioaji"]["secret_key"], fetch_contract=False)
+        ref = get_ref()
+        # 當日已有行程下載過合約表時，直接讀永豐的本地合約檔
+        api.fetch_contracts(contract_download=ref.stale("contracts"))
+        ref.refresh_contracts(api)
         return api, None
     except Exception as e:
         return None, str(e)
 
+class QuoteBook:
+    """
+    永豐即時成交回報: 訂閱排行名單，callback 持續更新最新價表
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.px = {}
+        self.subs = set()
+        self.api = None
+        self.state = None   # 當日 BreadthState，成交回報直接更新站上家數
+
+    def on_tick(self, exchange, tick):
+        try:
+            close = float(tick.close)
+            if close <= 0: return
+            val = {'price': close, 'y_close': close - float(tick.price_chg), 'ts': time_module.time()}
+            if getattr(tick, 'simtrade', False): val['note'] = "試撮"
+            with self.lock: self.px[tick.code] = val
+            state = self.state
+            if state is not None: state.update(tick.code, close, val['y_close'])
+        except: pass
+
+    def attach(self, api):
+        if api is self.api: return
+        state = self.state
+        self.detach()   # 重新登入: 舊連線的訂閱先退掉，廣度狀態沿用
+        self.state = state
+        with self.lock:
+            self.api = api; self.subs = set(); self.px = {}
+        api.quote.set_on_tick_stk_v1_callback(self.on_tick)
+
+    def unsubscribe(self, c):
+        try:
+            self.api.quote.unsubscribe(self.api.Contracts.Stocks[c], quote_type=sj.constant.QuoteType.Tick, version=sj.constant.QuoteVersion.v1)
+        except: pass
+        self.subs.discard(c)
+
+    def detach(self):
+        """
+        關閉串流: 退掉所有訂閱，停止更新最新價表與廣度狀態
+        """
+        self.state = None
+        if self.api is None: return
+        for c in list(self.subs): self.unsubscribe(c)
+        with self.lock:
+            self.api = None; self.subs = set(); self.px = {}
+
+    def sync(self, codes):
+        """
+        依名單增減訂閱 (上限 SJ_SUB_MAX 檔，其餘仍走快照)
+        """
+        api = self.api
+        ref = get_ref()
+        want = [c for c in codes if ref.contract(api, c) is not None][:SJ_SUB_MAX]
+        want_set = set(want)
+        for c in list(self.subs - want_set): self.unsubscribe(c)
+        for c in want:
+            if c in self.subs: continue
+            try:
+                api.quote.subscribe(ref.contract(api, c), quote_type=sj.constant.QuoteType.Tick, version=sj.constant.QuoteVersion.v1)
+                self.subs.add(c)
+            except: pass
+
+    def prices(self, codes, max_age=STREAM_MAX_AGE):
+        now = time_module.time()
+        with self.lock:
+            return {c: self.px[c] for c in codes if c in self.px and now - self.px[c]['ts'] <= max_age}
+
+@st.cache_resource
+def get_quote_book():
+    return QuoteBook()
+
 # ==========================================
 # 籌碼面資料處理
 # ==========================================
+ROUTE_LOCK = threading.Lock()
+
+def load_routes():
+    try:
+        with open(ROUTE_FILE, 'r') as f: return json.load(f)
+    except: return {"ok": {}, "dead": {}}
+
+def save_routes(routes):
+    try:
+        tmp = ROUTE_FILE + ".tmp"
+        with open(tmp, 'w') as f: json.dump(routes, f)
+        os.replace(tmp, ROUTE_FILE)
+    except: pass
+
 def call_finmind_api_try_versions(dataset_candidates, data_id, start_date, token):
+    """
+    依序嘗試 dataset x 版本；成功組合記在 ROUTE_FILE 下次優先使用，
+    回應端點 / dataset 不存在 (ROUTE_DEAD_STATUS) 者在 ROUTE_DEAD_TTL 秒內不再嘗試
+    """
     versions = ["v4", "v3", "v2"]
-    last_error = ""
-    for dataset in dataset_candidates:
-        for v in versions:
-            url = f"https://api.finmindtrade.com/api/{v}/data"
-            params = {"dataset": dataset, "start_date": start_date, "token": token}
-            if data_id: params["data_id"] = data_id
-            try:
-                r = cffi_requests.get(url, params=params, impersonate="chrome", timeout=10)
-                if r.status_code == 200:
-                    res_json = r.json()
-                    if "data" in res_json and len(res_json["data"]) > 0:
-                        return pd.DataFrame(res_json["data"]), f"{dataset} ({v})"
-            except Exception as e: last_error = str(e)
-    return pd.DataFrame(), last_error
+    key = "|".join(dataset_candidates)
+    with ROUTE_LOCK: routes = load_routes()
+    now = time_module.time()
+    combos = [(d, v) for d in dataset_candidates for v in versions]
+    known = routes["ok"].get(key)
+    if known and tuple(known) in combos:
+        combos.remove(tuple(known)); combos.insert(0, tuple(known))
+    dead = routes["dead"]
+    combos = [c for c in combos if now - dead.get(f"{c[0]}@{c[1]}", 0) > ROUTE_DEAD_TTL or list(c) == known]
+
+    last_error = "" if combos else "端點皆暫停嘗試"
+    found, newly_dead = None, []
+    result = pd.DataFrame()
+    tape = get_tape()
+    for dataset, v in combos:
+        url = f"https://api.finmindtrade.com/api/{v}/data"
+        params = {"dataset": dataset, "start_date": start_date, "token": token}
+        if data_id: params["data_id"] = data_id
+        def call():
+            r = cffi_requests.get(url, params=params, impersonate="chrome", timeout=10)
+            return {"status": r.status_code, "json": r.json() if r.status_code == 200 else None}
+        try:
+            r = tape.call("finmind_http", f"{v}/{dataset}:{data_id}:{start_date}", call)
+            if r["status"] == 200:
+                res_json = r["json"]
+                if "data" in res_json and len(res_json["data"]) > 0:
+                    result = pd.DataFrame(res_json["data"]); found = [dataset, v]
+                    break
+            else:
+                # 只有「端點 / dataset 不存在」才暫停；401/402 (token、額度)、429、5xx 屬暫時性錯誤
+                if r["status"] in ROUTE_DEAD_STATUS: newly_dead.append(f"{dataset}@{v}")
+                last_error = f"HTTP {r['status']}"
+        except Exception as e: last_error = str(e)
+
+    if found or newly_dead:
+        with ROUTE_LOCK:
+            routes = load_routes()
+            if found:
+                routes["ok"][key] = found
+                routes["dead"].pop(f"{found[0]}@{found[1]}", None)
+            for k in newly_dead: routes["dead"][k] = now
+            save_routes(routes)
+    if found: return result, f"{found[0]} ({found[1]})"
+    return result, last_error
 
 def get_taifex_pc_ratio(target_date_str):
     try:
@@ -191,9 +1024,12 @@ def get_taifex_pc_ratio(target_date_str):
             'queryEndDate': end_dt.strftime("%Y/%m/%d"),
             'queryDate': end_dt.strftime("%Y/%m/%d")
         }
-        r = cffi_requests.post(url, data=payload, impersonate="chrome", timeout=10)
-        if r.status_code == 200:
-            dfs = pd.read_html(io.StringIO(r.text))
+        def call():
+            r = cffi_requests.post(url, data=payload, impersonate="chrome", timeout=10)
+            return {"status": r.status_code, "text": r.text if r.status_code == 200 else ""}
+        r = get_tape().call("taifex", target_date_str, call)
+        if r["status"] == 200:
+            dfs = pd.read_html(io.StringIO(r["text"]))
             for df in dfs:
                 if df.shape[1] >= 7:
                     top_row = df.iloc[0] 
@@ -205,17 +1041,8 @@ def get_taifex_pc_ratio(target_date_str):
         return None, str(e)
     return None, "找不到表格"
 
-@st.cache_data(ttl=43200) 
-def get_chips_data(token, target_date_str):
-    diagnosis = [] 
-    if not token:
-        diagnosis.append("❌ 錯誤: 未設定 FinMind Token")
-        return None, diagnosis
-    
-    start_date = (datetime.strptime(target_date_str, "%Y-%m-%d") - timedelta(days=10)).strftime("%Y-%m-%d")
-    res = {}
-    
-    # 1. 期貨
+def chip_futures(start_date, token):
+    res, diagnosis = {}, []
     fut_candidates = ["TaiwanFuturesInstitutional", "TaiwanFuturesInstitutionalInvestors"]
     df_fut, fut_src = call_finmind_api_try_versions(fut_candidates, "TX", start_date, token)
     if df_fut.empty:
@@ -246,8 +1073,10 @@ def get_chips_data(token, target_date_str):
                     diagnosis.append(f"✅ 期貨(外資): 成功 ({res['fut_oi']})")
                 except: diagnosis.append("❌ 期貨: 計算錯誤")
         else: diagnosis.append("❌ 期貨: 欄位錯誤")
+    return res, diagnosis
 
-    # 2. 選擇權
+def chip_options(start_date, token, target_date_str):
+    res, diagnosis = {}, []
     pc_val = None
     df_opt, _ = call_finmind_api_try_versions(["TaiwanOptionDaily"], "TXO", start_date, token)
     if not df_opt.empty:
@@ -270,8 +1099,10 @@ def get_chips_data(token, target_date_str):
             
     if pc_val is not None:
         res['pc_ratio'] = pc_val
+    return res, diagnosis
 
-    # 3. 維持率
+def chip_maintenance(start_date, token):
+    res, diagnosis = {}, []
     maint_candidates = ["TaiwanTotalExchangeMarginMaintenance"]
     df_maint, _ = call_finmind_api_try_versions(maint_candidates, None, start_date, token)
     if not df_maint.empty:
@@ -281,8 +1112,10 @@ def get_chips_data(token, target_date_str):
         if col in latest:
             res['margin_ratio'] = float(latest[col])
             diagnosis.append(f"✅ 維持率: {res['margin_ratio']}%")
+    return res, diagnosis
 
-    # 4. 融資餘額
+def chip_margin(start_date, token):
+    res, diagnosis = {}, []
     df_margin, margin_src = call_finmind_api_try_versions(["TaiwanStockTotalMarginPurchaseShortSale"], None, start_date, token)
     if not df_margin.empty:
         df_money = df_margin[df_margin['name'] == 'MarginPurchaseMoney'].sort_values('date')
@@ -294,6 +1127,32 @@ def get_chips_data(token, target_date_str):
             res['margin_chg'] = round((curr_bal - prev_bal) / 100000000, 2) 
             res['margin_bal'] = round(curr_bal / 100000000, 1)
             diagnosis.append(f"✅ 融資餘額: {res['margin_bal']}億 (變動: {res['margin_chg']}億)")
+    return res, diagnosis
+
+@st.cache_data(ttl=43200) 
+def get_chips_data(token, target_date_str):
+    get_metrics().cache("chips", False)
+    diagnosis = [] 
+    if not token:
+        diagnosis.append("❌ 錯誤: 未設定 FinMind Token")
+        return None, diagnosis
+    
+    start_date = (datetime.strptime(target_date_str, "%Y-%m-%d") - timedelta(days=10)).strftime("%Y-%m-%d")
+    res = {}
+
+    # 1. 期貨 2. 選擇權 3. 維持率 4. 融資餘額 (同時發出)
+    with ThreadPoolExecutor(max_workers=4) as ex:
+        jobs = [
+            ex.submit(chip_futures, start_date, token),
+            ex.submit(chip_options, start_date, token, target_date_str),
+            ex.submit(chip_maintenance, start_date, token),
+            ex.submit(chip_margin, start_date, token),
+        ]
+        for job in jobs:
+            try:
+                part, diag = job.result()
+                res.update(part); diagnosis.extend(diag)
+            except Exception as e: diagnosis.append(f"❌ 籌碼資料錯誤: {e}")
 
     return res, diagnosis
 
@@ -323,23 +1182,90 @@ def get_chip_strategy(ma5_slope, chips):
     return {"sig": sig, "act": act, "color": color, "data": chips}
 
 # ==========================================
-# 資料處理 (一般)
+# 本地行情庫 (OHLC Store)
 # ==========================================
-def get_col(df, names):
-    cols = {c.lower(): c for c in df.columns}
-    for n in names:
-        if n in df.columns: return df[n]
-        if n.lower() in cols: return df[cols[n.lower()]]
-    return None
+def store_path(name):
+    return os.path.join(OHLC_DIR, f"{name}.parquet")
+
+def store_read(name):
+    path = store_path(name)
+    if not os.path.exists(path): return None
+    try: return pd.read_parquet(path)
+    except: return None
+
+def store_write(name, df):
+    try:
+        os.makedirs(OHLC_DIR, exist_ok=True)
+        tmp = store_path(name) + ".tmp"
+        df.to_parquet(tmp, index=False)
+        os.replace(tmp, store_path(name))
+    except: pass
+
+def store_meta(update=None):
+    path = os.path.join(OHLC_DIR, "meta.json")
+    meta = {}
+    try:
+        with open(path, 'r') as f: meta = json.load(f)
+    except: pass
+    if update:
+        meta.update(update)
+        try:
+            os.makedirs(OHLC_DIR, exist_ok=True)
+            with open(path, 'w') as f: json.dump(meta, f)
+        except: pass
+    return meta
+
+def expected_session(now=None):
+    """
+    目前應已有盤後資料的最近交易日 (僅排除週末，假日由 meta 的檢查時間擋下重複請求)
+    """
+    now = now or datetime.now(timezone(timedelta(hours=8)))
+    d = now.date()
+    if now.time() < STORE_READY_T: d -= timedelta(days=1)
+    while d.weekday() > 4: d -= timedelta(days=1)
+    return d.strftime("%Y-%m-%d")
+
+def sync_index_hist(token, start):
+    """
+    TAIEX 日線: 本地優先，只補抓最後一筆之後的新交易日
+    """
+    df = store_read("TAIEX")
+    meta = store_meta()
+    exp = expected_session()
+    have = df is not None and not df.empty
+    if have and meta.get("index_start", "9999") <= start:
+        last_d = str(df['date'].max())
+        checked = meta.get("index_checked", "")
+        recent = checked[:16] >= (datetime.now() - timedelta(minutes=30)).strftime("%Y-%m-%d %H:%M")
+        if last_d >= exp or (meta.get("index_expected") == exp and recent):
+            return df[df['date'] >= start].reset_index(drop=True)
+        fetch_from = last_d
+    else:
+        fetch_from = start
+        have = False
+
+    try: new = finmind_fetch(token, "taiwan_stock_daily", stock_id="TAIEX", start_date=fetch_from)
+    except: new = None
+
+    if new is not None:
+        upd = {"index_expected": exp, "index_checked": datetime.now().strftime("%Y-%m-%d %H:%M")}
+        if not new.empty:
+            new['date'] = new['date'].astype(str)
+            merged = pd.concat([df, new], ignore_index=True) if have else new
+            df = merged.drop_duplicates('date', keep='last').sort_values('date').reset_index(drop=True)
+            store_write("TAIEX", df)
+            if not have: upd["index_start"] = start
+        if have or not new.empty: store_meta(upd)
+    if df is None or df.empty: return pd.DataFrame()
+    return df[df['date'] >= start].reset_index(drop=True)
 
 @st.cache_data(ttl=600)
 def get_days(token):
-    api = DataLoader()
-    if token: api.login_by_token(token)
+    get_metrics().cache("days", False)
     dates = []
     try:
-        df = api.taiwan_stock_daily(stock_id="0050", start_date=(datetime.now()-timedelta(days=20)).strftime("%Y-%m-%d"))
-        if not df.empty: dates = sorted(df['date'].unique().tolist())
+        tw = sync_index_hist(token, (datetime.now()-timedelta(days=20)).strftime("%Y-%m-%d"))
+        if not tw.empty: dates = sorted(tw['date'].unique().tolist())
     except: pass
     now = datetime.now(timezone(timedelta(hours=8)))
     today_str = now.strftime("%Y-%m-%d")
@@ -348,192 +1274,731 @@ def get_days(token):
             dates.append(today_str)
     return dates
 
-@st.cache_data(ttl=86400)
+# ==========================================
+# 資料處理 (一般)
+# ==========================================
+def get_col(df, names):
+    cols = {c.lower(): c for c in df.columns}
+    for n in names:
+        if n in df.columns: return df[n]
+        if n.lower() in cols: return df[cols[n.lower()]]
+    return None
+
+INFO_COLS = ['stock_id', 'type', 'industry_category']
+
+class RefData:
+    """
+    參考資料快取 (跨行程共用): 代號 ➜ 市場 / 產業 / 是否有永豐合約
+    REF_DIR/index.npz 為排序代號 + 小整數編碼的緊湊索引，meta.json 記錄各來源的更新日
+    股票分類與合約清單每日各更新一次 (新資料覆蓋，已下市代號保留)；檔案變動才重讀
+    """
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.RLock()
+        self.mtime = None
+        self.codes = np.array([], dtype=str)
+        self.mkt = np.array([], dtype=np.uint8); self.ind = np.array([], dtype=np.uint16)
+        self.sj = np.array([], dtype=np.int8)   # -1 未知 / 0 無合約 / 1 有合約
+        self.mkt_names = [""]; self.ind_names = [""]
+        self.memo = {}
+        self.ct_api = None; self.ct = {}
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def meta(self, update=None):
+        meta = {}
+        try:
+            with open(self.path("meta.json"), 'r') as f: meta = json.load(f)
+        except: pass
+        if update:
+            meta.update(update)
+            try:
+                with open(self.path("meta.json") + ".tmp", 'w') as f: json.dump(meta, f)
+                os.replace(self.path("meta.json") + ".tmp", self.path("meta.json"))
+            except: pass
+        return meta
+
+    def load(self):
+        with self.lock:
+            path = self.path("index.npz")
+            mtime = os.path.getmtime(path) if os.path.exists(path) else None
+            if mtime == self.mtime: return
+            try:
+                with np.load(path) as z:
+                    self.codes = z['codes']; self.mkt = z['mkt']; self.ind = z['ind']; self.sj = z['sj']
+                    self.mkt_names = z['mkt_names'].tolist(); self.ind_names = z['ind_names'].tolist()
+            except: pass
+            self.mtime = mtime; self.memo = {}
+
+    def save(self, df):
+        """
+        df: stock_id / type / industry_category / sj ➜ index.npz
+        """
+        df = df.sort_values('stock_id').reset_index(drop=True)
+        mkt, mkt_names = pd.factorize(df['type'].fillna("").astype(str))
+        ind, ind_names = pd.factorize(df['industry_category'].fillna("").astype(str))
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            tmp = self.path("index.tmp.npz")
+            np.savez(tmp, codes=df['stock_id'].to_numpy(dtype=str), mkt=mkt.astype(np.uint8), ind=ind.astype(np.uint16),
+                     sj=df['sj'].to_numpy(dtype=np.int8), mkt_names=np.asarray(mkt_names, dtype=str), ind_names=np.asarray(ind_names, dtype=str))
+            os.replace(tmp, self.path("index.npz"))
+        except: pass
+        self.load()
+
+    def frame(self):
+        self.load()
+        with self.lock:
+            return pd.DataFrame({'stock_id': self.codes, 'type': np.asarray(self.mkt_names, dtype=object)[self.mkt],
+                                 'industry_category': np.asarray(self.ind_names, dtype=object)[self.ind], 'sj': self.sj})
+
+    def stale(self, source):
+        today = datetime.now(timezone(timedelta(hours=8))).strftime("%Y-%m-%d")
+        return self.meta().get(source) != today
+
+    def refresh_info(self, token):
+        """
+        股票分類每日一次；失敗後 REF_RETRY_SEC 秒內不重試
+        """
+        if not self.stale("info"): return
+        os.makedirs(self.root, exist_ok=True)
+        with file_lock(self.path("index")):
+            meta = self.meta()
+            if not self.stale("info") or time_module.time() - meta.get("info_fail", 0) < REF_RETRY_SEC: return
+            try:
+                new = finmind_fetch(token, "taiwan_stock_info")
+                if new is None or new.empty: raise ValueError("taiwan_stock_info 無資料")
+            except Exception:
+                self.meta({"info_fail": time_module.time()}); return
+            new = new.copy()
+            new['stock_id'] = new['stock_id'].astype(str)
+            if 'industry_category' not in new.columns: new['industry_category'] = ""
+            new = new[INFO_COLS].drop_duplicates('stock_id', keep='last')
+            old = self.frame()
+            sj_flags = old.set_index('stock_id')['sj']
+            new['sj'] = new['stock_id'].map(sj_flags).fillna(-1).astype(np.int8)
+            self.save(pd.concat([old[~old['stock_id'].isin(new['stock_id'])], new], ignore_index=True))
+            self.meta({"info": datetime.now(timezone(timedelta(hours=8))).strftime("%Y-%m-%d"), "info_fail": 0})
+
+    def refresh_contracts(self, api):
+        """
+        登入後由永豐合約表標記哪些代號有合約 (每日一次)
+        """
+        if not self.stale("contracts"): return
+        os.makedirs(self.root, exist_ok=True)
+        with file_lock(self.path("index")):
+            if not self.stale("contracts"): return
+            have = set()
+            try:
+                for ex in api.Contracts.Stocks:
+                    for ct in ex: have.add(str(ct.code))
+            except Exception: return
+            if not have: return
+            old = self.frame()
+            old['sj'] = old['stock_id'].isin(have).astype(np.int8)
+            extra = sorted(have - set(old['stock_id']))
+            add = pd.DataFrame({'stock_id': extra, 'type': "", 'industry_category': "", 'sj': np.ones(len(extra), dtype=np.int8)})
+            self.save(pd.concat([old, add], ignore_index=True))
+            self.meta({"contracts": datetime.now(timezone(timedelta(hours=8))).strftime("%Y-%m-%d")})
+
+    def table(self):
+        self.load()
+        with self.lock:
+            if 'table' not in self.memo:
+                df = self.frame()
+                self.memo['table'] = df[df['type'] != ""][INFO_COLS].reset_index(drop=True)
+            return self.memo['table']
+
+    def market_map(self):
+        self.load()
+        with self.lock:
+            if 'mkt' not in self.memo:
+                df = self.table()
+                self.memo['mkt'] = dict(zip(df['stock_id'], df['type']))
+            return self.memo['mkt']
+
+    def has_contract(self, code):
+        """
+        True / False；索引沒有當日合約資料時回 None
+        """
+        self.load()
+        i = np.searchsorted(self.codes, code)
+        if i >= len(self.codes) or self.codes[i] != code or self.sj[i] < 0: return None
+        return bool(self.sj[i])
+
+    def contract(self, api, code):
+        """
+        代號 ➜ 永豐合約物件 (同一個 api 內記憶查詢結果)；確定沒有合約的代號不查
+        """
+        with self.lock:
+            if api is not self.ct_api: self.ct_api = api; self.ct = {}
+            if code in self.ct: return self.ct[code]
+        if self.has_contract(code) is False: ct = None
+        else:
+            try: ct = api.Contracts.Stocks[code] if code in api.Contracts.Stocks else None
+            except Exception: ct = None
+        with self.lock: self.ct[code] = ct
+        return ct
+
+@st.cache_resource
+def get_ref():
+    return RefData(REF_DIR)
+
+def get_stock_info_table(token):
+    """
+    taiwan_stock_info 精簡表 (每檔一列: stock_id, type, industry_category)，由參考資料快取提供
+    """
+    ref = get_ref()
+    ref.refresh_info(token)
+    return ref.table()
+
 def get_stock_info_map(token):
     base_map = {
         "2330":"twse", "2317":"twse", "2454":"twse", "2303":"twse", "2308":"twse",
         "0050":"twse", "0056":"twse", "00878":"twse", "t00": "twse"
     }
-    api = DataLoader()
-    if token: api.login_by_token(token)
-    try:
-        df = api.taiwan_stock_info()
-        if df.empty: return base_map
-        df['stock_id'] = df['stock_id'].astype(str)
-        api_map = dict(zip(df['stock_id'], df['type']))
-        base_map.update(api_map)
-        return base_map
-    except: return base_map
+    ref = get_ref()
+    ref.refresh_info(token)
+    mkt = ref.market_map()
+    if not mkt: return base_map
+    return {**base_map, **mkt}
+
+RANK_LOCK = threading.Lock()
+rank_mem = {"mtime": None, "data": {}}
+
+def load_rank_archive():
+    """
+    成交值排行檔 (date -> ids/money)，常駐記憶體，檔案變動才重讀
+    """
+    with RANK_LOCK:
+        if not os.path.exists(RANK_FILE):
+            if rank_mem["mtime"] is not None: rank_mem.update(mtime=None, data={})
+            legacy = {}
+            try:
+                with open(RANK_LEGACY_FILE, 'r') as f: legacy = json.load(f)
+            except: pass
+            if legacy.get("date") and legacy.get("ranks") and not rank_mem["data"]:
+                rank_mem["data"] = {legacy["date"]: {"ids": legacy["ranks"], "money": []}}
+            return rank_mem["data"]
+        mtime = os.path.getmtime(RANK_FILE)
+        if mtime != rank_mem["mtime"]:
+            try:
+                with open(RANK_FILE, 'r') as f: rank_mem["data"] = json.load(f)
+            except: rank_mem["data"] = {}
+            rank_mem["mtime"] = mtime
+        return rank_mem["data"]
+
+def save_rank_entries(entries):
+    """
+    合併寫入多個交易日的排行，只保留最近 RANK_KEEP_DAYS 個交易日
+    """
+    if not entries: return
+    with file_lock(RANK_FILE):
+        data = dict(load_rank_archive())
+        data.update(entries)
+        data = {d: data[d] for d in sorted(data)[-RANK_KEEP_DAYS:]}
+        with RANK_LOCK:
+            try:
+                tmp = RANK_FILE + ".tmp"
+                with open(tmp, 'w') as f: json.dump(data, f, separators=(',', ':'))
+                os.replace(tmp, RANK_FILE)
+                rank_mem.update(mtime=os.path.getmtime(RANK_FILE), data=data)
+            except: pass
+
+def rank_market_day(df, n=TOP_N):
+    """
+    單日全市場 ➜ 成交值前 n 名 (4 碼普通股，排除 EXCL_PFX)，回傳 (代號, 成交值)
+    """
+    ids = get_col(df, ['stock_id','code'])
+    money = get_col(df, ['Trading_money','turnover'])
+    if ids is None or money is None: return [], []
+    t = pd.DataFrame({'ID': ids.astype(str).values, 'Money': pd.to_numeric(money, errors='coerce').values})
+    ok = (t['ID'].str.len()==4) & t['ID'].str.isdigit()
+    for p in EXCL_PFX: ok &= ~t['ID'].str.startswith(p)
+    t = t[ok].sort_values('Money', ascending=False).head(n)
+    return t['ID'].tolist(), t['Money'].fillna(0).astype(float).tolist()
+
+def get_rank_entry(d):
+    return load_rank_archive().get(str(d))
+
+@st.cache_resource
+def get_rank_retry():
+    return {}
+
+def backfill_ranks(token, dates):
+    """
+    一次補齊排行檔缺少的交易日 (各日同時抓取，本地行情庫有的直接讀)
+    抓不到完整全市場資料的日子 RANK_RETRY_SEC 秒內不再重抓
+    """
+    have = load_rank_archive()
+    retry = get_rank_retry()
+    now = time_module.time()
+    missing = [d for d in dates if d not in have and retry.get(d, 0) <= now]
+    if not missing: return 0
+    def build(d):
+        df = load_market_day(token, d)
+        if len(df) <= FULL_MARKET_MIN: return d, None
+        ids, money = rank_market_day(df)
+        return d, ({"ids": ids, "money": money} if ids else None)
+    with ThreadPoolExecutor(max_workers=4) as ex:
+        entries = {d: e for d, e in ex.map(build, missing) if e}
+    for d in missing:
+        if d not in entries: retry[d] = now + RANK_RETRY_SEC
+    save_rank_entries(entries)
+    return len(entries)
 
 def get_ranks_strict(token, target_date_str, min_count=0):
-    if min_count == 0 and os.path.exists(RANK_FILE):
-        try:
-            with open(RANK_FILE, 'r') as f:
-                data = json.load(f)
-                if data.get("date") == target_date_str and data.get("ranks"):
-                    return data["ranks"], True
-        except: pass
+    entry = get_rank_entry(target_date_str)
+    get_metrics().cache("ranks", bool(entry and entry.get("ids")))
+    if entry and entry.get("ids"):
+        return entry["ids"][:TOP_N], True
 
-    api = DataLoader()
-    if token: api.login_by_token(token)
-    df = pd.DataFrame()
-    try: df = api.taiwan_stock_daily(stock_id="", start_date=target_date_str)
-    except: pass
-    
+    df = load_market_day(token, target_date_str)
     if df.empty: return [], False
 
     if min_count > 0 and len(df) < min_count:
         return [], False
 
-    df['ID'] = get_col(df, ['stock_id','code'])
-    df['Money'] = get_col(df, ['Trading_money','turnover'])
-    if df['ID'] is None or df['Money'] is None: return [], False
-    
-    df['ID'] = df['ID'].astype(str)
-    df = df[df['ID'].str.len()==4]
-    df = df[df['ID'].str.isdigit()]
-    for p in EXCL_PFX: df = df[~df['ID'].str.startswith(p)]
-     
-    ranks = df.sort_values('Money', ascending=False).head(TOP_N)['ID'].tolist()
+    ranks, money = rank_market_day(df)
     
-    if ranks and (min_count == 0 or len(df) > 1500):
-        try:
-            with open(RANK_FILE, 'w') as f:
-                json.dump({"date": target_date_str, "ranks": ranks}, f)
-        except: pass
+    if ranks and (min_count == 0 or len(df) > FULL_MARKET_MIN):
+        save_rank_entries({target_date_str: {"ids": ranks, "money": money}})
         
     return ranks, False
 
 @st.cache_data(ttl=43200)
 def get_hist(token, code, start):
-    api = DataLoader()
-    if token: api.login_by_token(token)
-    try: return api.taiwan_stock_daily(stock_id=code, start_date=start)
+    if code == "TAIEX": return sync_index_hist(token, start)
+    try: return finmind_fetch(token, "taiwan_stock_daily", stock_id=code, start_date=start)
     except: return pd.DataFrame()
 
-def get_prices_twse_mis(codes, info_map):
-    if not codes: return {}, {}
-    
-    session = cffi_requests.Session(impersonate="chrome")
-    headers = {
+def load_market_day(token, d):
+    """
+    全市場單日行情 (本地行情庫優先，完整的盤後資料才寫入)
+    """
+    df = store_read(d)
+    get_metrics().cache("market_day", df is not None and not df.empty)
+    if df is not None and not df.empty: return df
+    try: df = finmind_fetch(token, "taiwan_stock_daily", stock_id="", start_date=d)
+    except: return pd.DataFrame()
+    if len(df) >= FULL_MARKET_MIN:
+        df['date'] = df['date'].astype(str)
+        store_write(d, df)
+    return df
+
+@st.cache_data(ttl=43200)
+def get_market_closes(token, d):
+    return market_close_series(load_market_day(token, d))
+
+def market_close_series(df):
+    if df.empty: return pd.Series(dtype=float)
+    ids = get_col(df, ['stock_id','code'])
+    closes = get_col(df, ['close'])
+    if ids is None or closes is None: return pd.Series(dtype=float)
+    s = pd.Series(pd.to_numeric(closes, errors='coerce').values, index=ids.astype(str).values)
+    s = s[~s.index.duplicated(keep='last')]
+    return s[s > 0]
+
+@st.cache_data(ttl=43200)
+def get_close_matrix(token, start):
+    """
+    收盤價矩陣 (列: 交易日, 欄: 代號, 另含 TAIEX 欄)
+    以 TAIEX 日線決定交易日，每個交易日只打一次全市場請求
+    """
+    tw = get_hist(token, "TAIEX", start)
+    if tw.empty: return pd.DataFrame()
+    return build_close_matrix(token, tw)
+
+def build_close_matrix(token, tw):
+    get_metrics().cache("close_matrix", False)
+    tw = tw.copy()
+    tw['date'] = tw['date'].astype(str)
+    tw = tw.drop_duplicates('date', keep='last').sort_values('date')
+    cols = {}
+    for d in tw['date']:
+        s = get_market_closes(token, d)
+        if not s.empty: cols[d] = s
+    mat = pd.DataFrame(cols).T if cols else pd.DataFrame(index=tw['date'])
+    mat = mat.reindex(tw['date'].tolist())
+    mat['TAIEX'] = pd.to_numeric(tw['close'], errors='coerce').values
+    mat.index.name = 'date'
+    return mat
+
+def mat_hist(mat, code):
+    """
+    由收盤價矩陣取出單一代號的日線 (欄位同 get_hist: date, close)
+    """
+    if mat.empty or code not in mat.columns:
+        return pd.DataFrame(columns=['date', 'close'])
+    s = mat[code].dropna()
+    return pd.DataFrame({'date': s.index.astype(str), 'close': s.values})
+
+class TokenBucket:
+    """
+    權杖桶限速: 平均 rate 次/秒，最多連發 burst 次 (多執行緒共用)
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate; self.burst = burst
+        self.tokens = burst; self.ts = time_module.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time_module.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.ts) * self.rate)
+                self.ts = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time_module.sleep(wait)
+
+class MisPool:
+    """
+    MIS 長連線池: 每個 session 各自保留 cookie，逾時才重新暖機
+    """
+    HEADERS = {
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36",
         "Referer": "https://mis.twse.com.tw/stock/fibest.jsp?lang=zh_tw",
         "Host": "mis.twse.com.tw",
         "X-Requested-With": "XMLHttpRequest",
     }
-    session.headers.update(headers)
-    
-    try:
-        ts_now = int(time_module.time() * 1000)
-        session.get(f"https://mis.twse.com.tw/stock/fibest.jsp?lang=zh_tw&_={ts_now}", timeout=10)
-        time_module.sleep(1)
-    except:
-        return {}, {c: "初始化失敗" for c in codes}
 
-    req_strs = []
-    chunk_size = 50 
-    results = {}
-    debug_log = {}
+    def __init__(self, size, rate, burst):
+        self.bucket = TokenBucket(rate, burst)
+        self.idle = queue.Queue()
+        for _ in range(size): self.idle.put({"sess": None, "warm": 0})
 
-    for i in range(0, len(codes), chunk_size):
-        chunk = codes[i:i+chunk_size]
-        q_list = []
-        for c in chunk:
-            c = str(c).strip()
-            if not c: continue
-            
-            m_type = info_map.get(c, "twse").lower()
-            if "twse" in m_type:
-                q_list.append(f"tse_{c}.tw")
-            else:
-                q_list.append(f"otc_{c}.tw")
-                 
-        if q_list:
-            req_strs.append("|".join(q_list))
-    
-    base_url = "https://mis.twse.com.tw/stock/api/getStockInfo.jsp"
-    
-    for idx, q_str in enumerate(req_strs):
-        ts = int(time_module.time() * 1000)
-        params = {"json": "1", "delay": "0", "_": ts, "ex_ch": q_str}
-        
+    def warm(self, slot):
+        if slot["sess"] is not None and time_module.time() - slot["warm"] < MIS_WARM_TTL:
+            return True
+        sess = cffi_requests.Session(impersonate="chrome")
+        sess.headers.update(self.HEADERS)
         try:
-            time_module.sleep(random.uniform(0.3, 0.8))
-            r = session.get(base_url, params=params, timeout=10)
-            
-            if r.status_code == 200:
-                try:
-                    data = r.json()
-                    if 'msgArray' not in data: continue
-                    
-                    for item in data['msgArray']:
-                        c = item.get('c', '') 
-                        z = item.get('z', '-') 
-                        y = item.get('y', '-') 
-                        pz = item.get('pz', '-') 
-                        val = {}
-                        if y!='-' and y!='': val['y'] = float(y)
-                        price = 0
-                        note = ""
-                        
-                        if z and z != '-' and z.replace('.','').isdigit(): 
-                            price = float(z); note="成交"
-                        elif pz and pz != '-' and pz.replace('.','').isdigit(): 
-                            price = float(pz); note="試撮"
-                        
-                        if price == 0:
-                            b_str = item.get('b','').split('_')[0]
-                            a_str = item.get('a','').split('_')[0]
-                            if b_str and b_str != '-' and b_str != '0':
-                                try: price = float(b_str); note = "漲停試算"
-                                except: pass
-                            if price == 0 and a_str and a_str != '-' and a_str != '0':
-                                try: price = float(a_str); note = "跌停試算"
-                                except: pass
-                        
-                        if price > 0:
-                            val['z'] = price; val['note'] = note
-                            results[c] = val
-                        else: debug_log[c] = "無價"
+            self.bucket.acquire()
+            ts_now = int(time_module.time() * 1000)
+            sess.get(f"https://mis.twse.com.tw/stock/fibest.jsp?lang=zh_tw&_={ts_now}", timeout=10)
+        except:
+            slot["sess"] = None
+            return False
+        slot["sess"] = sess; slot["warm"] = time_module.time()
+        return True
+
+    def get(self, url, params, timing=None):
+        """
+        timing 為 dict 時記錄實際請求的起點 (monotonic) 與耗時，不含等待連線與限速
+        """
+        slot = self.idle.get()
+        try:
+            if not self.warm(slot): return None
+            self.bucket.acquire()
+            params = dict(params, _=int(time_module.time() * 1000))
+            t0 = time_module.monotonic()
+            if timing is not None: timing['start'] = t0
+            try: return slot["sess"].get(url, params=params, timeout=10)
+            except:
+                slot["sess"] = None
+                return None
+            finally:
+                if timing is not None: timing['sec'] = time_module.monotonic() - t0
+        finally: self.idle.put(slot)
+
+@st.cache_resource
+def get_mis_pool():
+    return MisPool(MIS_WORKERS, MIS_RATE, MIS_BURST)
+
+def parse_mis_items(data, results, debug_log):
+    for item in data.get('msgArray', []):
+        c = item.get('c', '') 
+        z = item.get('z', '-') 
+        y = item.get('y', '-') 
+        pz = item.get('pz', '-') 
+        val = {}
+        if y!='-' and y!='': val['y'] = float(y)
+        price = 0
+        note = ""
+        
+        if z and z != '-' and z.replace('.','').isdigit(): 
+            price = float(z); note="成交"
+        elif pz and pz != '-' and pz.replace('.','').isdigit(): 
+            price = float(pz); note="試撮"
+        
+        if price == 0:
+            b_str = item.get('b','').split('_')[0]
+            a_str = item.get('a','').split('_')[0]
+            if b_str and b_str != '-' and b_str != '0':
+                try: price = float(b_str); note = "漲停試算"
                 except: pass
-        except: pass
-             
+            if price == 0 and a_str and a_str != '-' and a_str != '0':
+                try: price = float(a_str); note = "跌停試算"
+                except: pass
+        
+        if price > 0:
+            val['z'] = price; val['note'] = note
+            results[c] = val
+        else: debug_log[c] = "無價"
+
+def mis_queries(codes, info_map, chunk_size=50):
+    """
+    代號 ➜ [(批次代號, ex_ch 查詢字串)]，依 info_map 分上市 / 上櫃
+    """
+    out = []
+    for i in range(0, len(codes), chunk_size):
+        chunk = [str(c).strip() for c in codes[i:i+chunk_size]]
+        chunk = [c for c in chunk if c]
+        q_list = [f"tse_{c}.tw" if "twse" in info_map.get(c, "twse").lower() else f"otc_{c}.tw" for c in chunk]
+        if q_list: out.append((chunk, "|".join(q_list)))
+    return out
+
+def mis_fetch(q_str, timing=None):
+    """
+    單批 MIS 查詢 (經過錄放帶)；連線失敗回 None，非 200 回 {}
+    """
+    pool = get_mis_pool()
+    def call():
+        r = pool.get("https://mis.twse.com.tw/stock/api/getStockInfo.jsp", {"json": "1", "delay": "0", "ex_ch": q_str}, timing)
+        if r is None: return None
+        if r.status_code != 200: return {}
+        try: return r.json()
+        except: return {}
+    try: return get_tape().call("mis", q_str, call)
+    except TapeMiss: return None
+
+# ==========================================
+# 報價來源 (對沖請求 + 斷路器)
+# ==========================================
+class SourceHealth:
+    """
+    單一報價來源的健康度: 成功延遲 EWMA、最近 HEALTH_WIN 批的錯誤率與斷路器
+    closed ➜ 錯誤率超過 BREAKER_ERR ➜ open ➜ BREAKER_COOL 秒後 half 放行一輪試探 ➜ 成功 closed / 失敗 open
+    """
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.lat = None; self.recent = deque(maxlen=HEALTH_WIN)
+        self.state = "closed"; self.opened = 0; self.probing = False
+        self.calls = 0; self.errs = 0; self.trips = 0; self.last_err = ""
+
+    def err_rate(self):
+        return 1 - sum(self.recent) / len(self.recent) if self.recent else 0.0
+
+    def usable(self):
+        with self.lock:
+            return self.state == "closed" or (self.state == "open" and time_module.monotonic() - self.opened >= BREAKER_COOL)
+
+    def allow(self):
+        """
+        是否放行一輪請求；half 狀態同時只放行一輪試探
+        """
+        with self.lock:
+            if self.state == "closed": return True
+            if self.state == "open" and time_module.monotonic() - self.opened >= BREAKER_COOL:
+                self.state = "half"; self.probing = False
+            if self.state == "half" and not self.probing:
+                self.probing = True
+                return True
+            return False
+
+    def release(self):
+        """
+        試探批次全數未送出時，讓下一輪可以再試探
+        """
+        with self.lock:
+            if self.state == "half": self.probing = False
+
+    def record(self, ok, sec, err=""):
+        with self.lock:
+            self.calls += 1; self.recent.append(ok)
+            if ok: self.lat = sec if self.lat is None else 0.8 * self.lat + 0.2 * sec
+            else: self.errs += 1; self.last_err = err
+            if self.state == "half":
+                if ok: self.state = "closed"; self.recent.clear()
+                else: self.trip()
+            elif self.state == "closed" and len(self.recent) >= BREAKER_MIN and self.err_rate() > BREAKER_ERR:
+                self.trip()
+
+    def trip(self):
+        self.state = "open"; self.opened = time_module.monotonic(); self.trips += 1; self.probing = False
+
+    def row(self):
+        with self.lock:
+            return {"來源": self.name, "狀態": {"closed": "🟢 正常", "open": "🔴 跳脫", "half": "🟡 試探"}[self.state],
+                    "延遲(ms)": round(self.lat * 1000) if self.lat is not None else None,
+                    "錯誤率": round(self.err_rate(), 2), "呼叫": self.calls, "錯誤": self.errs,
+                    "跳脫": self.trips, "最後錯誤": self.last_err}
+
+def snap_enc(snaps):
+    return [{'code': s.code, 'close': float(s.close), 'reference_price': float(s.reference_price)} for s in snaps]
+
+def snap_dec(v):
+    return [SimpleNamespace(**s) for s in v]
+
+def sj_snapshot_chunk(sj_api, chunk, bucket, timing):
+    bucket.acquire()
+    timing['start'] = t0 = time_module.monotonic()
+    try:
+        snaps = get_tape().call("sj", "snapshots:" + ",".join(ct.code for ct in chunk),
+                                lambda: sj_api.snapshots(chunk, timeout=int(SJ_CALL_TIMEOUT * 1000)), snap_enc, snap_dec)
+    finally: timing['sec'] = time_module.monotonic() - t0
+    return {s.code: {'price': float(s.close), 'y_close': float(s.reference_price)} for s in snaps if s.close > 0}, {}
+
+def mis_chunk(q_str, timing):
+    data = mis_fetch(q_str, timing)
+    if data is None: raise ConnectionError("MIS 連線失敗")
+    if not data: raise ConnectionError("MIS 回應錯誤")
+    results, debug_log = {}, {}
+    parse_mis_items(data, results, debug_log)
     return results, debug_log
 
+class QuoteSources:
+    """
+    對沖報價: 健康度最佳的來源先發，HEDGE_DELAY 秒內未回齊 (或主來源報不了的代號) 才對備援來源發出，
+    每檔取最先回來的報價；期限為 deadline 加上依批次數與限速估計的排隊時間
+    兩個來源各有自己的執行緒池，一方卡住不會佔用另一方；健康度只計實際請求的耗時，
+    期限到時已送出未回的批次記為逾時，尚未送出的批次直接取消、不算來源錯誤
+    """
+    NAMES = {"sj": "永豐API", "mis": "證交所MIS"}
+    STAGES = {"sj": "sj_snapshots", "mis": "mis"}
+    RATES = {"sj": SJ_RATE, "mis": MIS_RATE}
+
+    def __init__(self):
+        self.health = {k: SourceHealth(v) for k, v in self.NAMES.items()}
+        self.ex = {"sj": ThreadPoolExecutor(max_workers=SJ_WORKERS, thread_name_prefix="quote-sj"),
+                   "mis": ThreadPoolExecutor(max_workers=MIS_WORKERS, thread_name_prefix="quote-mis")}
+        self.aux = ThreadPoolExecutor(max_workers=1, thread_name_prefix="quote-usage")
+        self.sj_bucket = TokenBucket(SJ_RATE, SJ_RATE)
+
+    def rank(self, avail):
+        """
+        可用來源依 (是否正常, 延遲 EWMA) 排序；尚無延遲紀錄者沿用 avail 的順序
+        """
+        ok = [s for s in avail if self.health[s].usable()]
+        return sorted(ok, key=lambda s: (self.health[s].state != "closed", self.health[s].lat or 0.0, avail.index(s)))
+
+    def batches(self, src, codes, sj_api, info_map):
+        if src == "sj":
+            ref = get_ref()
+            cs = [ct for ct in (ref.contract(sj_api, c) for c in codes) if ct is not None]
+            return [([ct.code for ct in cs[i:i+50]], lambda t, chunk=cs[i:i+50]: sj_snapshot_chunk(sj_api, chunk, self.sj_bucket, t))
+                    for i in range(0, len(cs), 50)]
+        return [(chunk, lambda t, q=q: mis_chunk(q, t)) for chunk, q in mis_queries(codes, info_map)]
+
+    def run(self, job, fn, cv, px, why, won):
+        t0 = time_module.monotonic()
+        try: res, dbg = fn(job['timing']); ok, err = True, ""
+        except Exception as e: res, dbg, ok, err = {}, {}, False, str(e) or type(e).__name__
+        sec = job['timing'].get('sec', time_module.monotonic() - t0)   # 重播時沒有實際請求，以整段計
+        with cv:
+            if job['late']: return   # 已記為逾時，結果不再採用
+            job['done'] = True
+            self.health[job['src']].record(ok, sec, err)
+            get_metrics().add(self.STAGES[job['src']], calls=1, sec=sec, err=0 if ok else 1)
+            for c, v in res.items():
+                if c not in px: px[c] = v; won[job['src']] += 1
+            for c in job['codes']:
+                if c in px: continue
+                if c in dbg: why[c] = dbg[c]
+                elif not ok: why[c] = f"{self.NAMES[job['src']]}失敗"
+            if not ok: job['err'] = err
+            cv.notify_all()
+
+    def fetch(self, codes, sj_api, info_map, deadline=QUOTE_DEADLINE):
+        """
+        回傳 {"px": 代號 ➜ 報價, "why": 無報價原因, "won": 各來源先到檔數, "degraded": 本輪是否有來源異常}
+        """
+        t_end = time_module.monotonic() + deadline
+        avail = (["sj"] if sj_api is not None else []) + ["mis"]
+        order = self.rank(avail)
+        px, why, won = {}, {}, dict.fromkeys(avail, 0)
+        cv = threading.Condition()
+        jobs, sent = [], {s: set() for s in avail}
+        degraded = len(order) < len(avail)
+
+        def launch(src, want):
+            nonlocal t_end
+            want = [c for c in want if c not in sent[src] and c not in px]
+            batches = self.batches(src, want, sj_api, info_map) if want else []
+            if not batches or not self.health[src].allow(): return False
+            sent[src].update(want)
+            for batch, fn in batches:
+                job = {'src': src, 'codes': batch, 'late': False, 'done': False, 'timing': {}}
+                jobs.append(job)
+                job['fut'] = self.ex[src].submit(self.run, job, fn, cv, px, why, won)
+            t_end = max(t_end, time_module.monotonic() + deadline + len(batches) / self.RATES[src])
+            return True
+
+        with cv:
+            if order:
+                launch(order[0], codes)
+                if order[0] == "sj" and len(order) > 1:   # 無永豐合約的代號直接交給備援
+                    launch(order[1], [c for c in codes if get_ref().contract(sj_api, c) is None])
+            backups = order[1:]
+            hedge_at = time_module.monotonic() + HEDGE_DELAY
+            while True:
+                missing = [c for c in codes if c not in px]
+                running = any(not j['done'] for j in jobs)
+                now = time_module.monotonic()
+                if not missing or now >= t_end: break
+                if backups and (now >= hedge_at or not running):
+                    for b in backups: launch(b, missing)
+                    backups = []
+                    continue
+                if not running: break
+                cv.wait(max(0.01, min(t_end, hedge_at if backups else t_end) - now))
+            for j in jobs:
+                if j['done']: continue
+                j['late'] = True
+                j['fut'].cancel()
+                start = j['timing'].get('start')
+                if start is not None:   # 已送出未回才算來源逾時
+                    sec = time_module.monotonic() - start
+                    self.health[j['src']].record(False, sec, "逾時")
+                    get_metrics().add(self.STAGES[j['src']], calls=1, sec=sec, err=1)
+                    j['err'] = "逾時"
+                for c in j['codes']:
+                    if c not in px: why.setdefault(c, f"{self.NAMES[j['src']]}{'逾時' if start is not None else '未送出'}")
+            for src in {j['src'] for j in jobs}: self.health[src].release()
+            degraded = degraded or any(j.get('err') for j in jobs)
+            px = dict(px); why = {c: r for c, r in why.items() if c not in px}
+        return {"px": px, "why": why, "won": dict(won), "degraded": degraded}
+
+    def usage(self, sj_api, timeout=2.0):
+        """
+        永豐 API 額度 (有期限；斷路器跳脫時不查)
+        """
+        if not self.health["sj"].usable(): return "來源跳脫中"
+        fut = self.aux.submit(get_tape().call, "sj", "usage", lambda: str(sj_api.usage(timeout=int(timeout * 1000)) or "無法取得"))
+        try: return fut.result(timeout=timeout)
+        except Exception: return "無法取得"
+
+    def table(self):
+        return pd.DataFrame([h.row() for h in self.health.values()])
+
+@st.cache_resource
+def get_quote_sources():
+    return QuoteSources()
+
 def save_rec(d, t, b, tc, t_cur, t_prev, intra, total_v):
-    if t_cur == 0: return 
-    t_short = t[:5] 
-    row = pd.DataFrame([{
-        'Date':d, 'Time':t_short, 'Breadth':b, 
+    if t_cur == 0 or total_v == 0: return 
+    t_short = t[:5] if intra else "13:30"   # 盤外的取樣一律記為收盤列
+    row = {
+        'Date':str(d), 'Time':t_short, 'Breadth':b, 
         'Taiex_Change':tc, 'Taiex_Current':t_cur, 'Taiex_Prev_Close':t_prev,
         'Total': total_v
-    }])
-    if not os.path.exists(HIST_FILE): 
-        row.to_csv(HIST_FILE, index=False)
-        return
-
+    }
     try:
-        df = pd.read_csv(HIST_FILE)
-        if df.empty: 
-            row.to_csv(HIST_FILE, index=False)
-            return
-
-        if 'Total' not in df.columns: df['Total'] = 0
-        df['Date'] = df['Date'].astype(str)
-        df['Time'] = df['Time'].astype(str)
-        
-        last_d = str(df.iloc[-1]['Date'])
-        last_t = str(df.iloc[-1]['Time'])[:5]
-        
-        if last_d != str(d): 
-            pd.concat([df, row], ignore_index=True).to_csv(HIST_FILE, index=False)
-        else:
-            if not intra: 
-                df = df[df['Date'] != str(d)]
-                pd.concat([df, row], ignore_index=True).to_csv(HIST_FILE, index=False)
-            elif last_t != str(t_short): 
-                row.to_csv(HIST_FILE, mode='a', header=False, index=False)
-    except: row.to_csv(HIST_FILE, index=False)
+        hist = get_history()
+        with file_lock(HIST_DIR):
+            last = hist.last()
+            if last is None or last['Date'] != str(d):
+                hist.append(row)
+            elif not intra:
+                hist.put_close(str(d), row)
+            elif last['Time'] != t_short:
+                hist.append(row)
+    except: pass
 
 def display_strategy_panel(slope, open_br, br, n_state, chip_strategy, chip_diag):
     # [UI優化 1/2] 注入 CSS 強制縮小 metric 數字字體 (26px -> 20px)
@@ -600,37 +2065,32 @@ def display_strategy_panel(slope, open_br, br, n_state, chip_strategy, chip_diag
         with st.expander("🔍 連線診斷報告", expanded=True):
             for msg in chip_diag: st.write(msg)
 
-def plot_chart():
-    chart_data = pd.DataFrame()
-    base_d = ""
-    
-    if os.path.exists(HIST_FILE):
-        try:
-            df = pd.read_csv(HIST_FILE)
-            if not df.empty:
-                df['Date'] = df['Date'].astype(str)
-                df['Time'] = df['Time'].astype(str)
-                df['Time'] = df['Time'].apply(lambda x: x[:5])
-                
-                df_today = df[df['Time'] >= "09:00"].copy()
-                if not df_today.empty:
-                    df_today = df_today.sort_values(['Date', 'Time'])
-                    last_date = df_today.iloc[-1]['Date']
-                    chart_data = df_today[df_today['Date'] == last_date].copy()
-                    base_d = last_date
-        except: pass
+def plot_chart(df_day=None, base_d="", overlay=0):
+    """
+    今日廣度/大盤走勢，可疊加前 overlay 個交易日的廣度曲線 (對齊到同一時間軸)
+    曲線取自 BreadthHistory 的逐日快取，每條最多 CHART_MAX_PTS 點
+    """
+    chart_data = pd.DataFrame(); prev = []
+    try:
+        hist = get_history()
+        if df_day is None:
+            base_d = next(iter(hist.sessions()), "")
+            if base_d: chart_data = hist.series(base_d)
+        elif not df_day.empty:
+            ser = new_series(); series_extend(ser, df_day.to_dict('records'))
+            chart_data = series_frame(ser, base_d)
+        if base_d and overlay > 0:
+            prev = [hist.series(d) for d in hist.sessions(base_d, overlay)]
+    except: pass
 
-    if chart_data.empty or base_d == "":
-        base_d = datetime.now().strftime("%Y-%m-%d")
-        start = pd.to_datetime(f"{base_d} 09:00:00")
-        end = pd.to_datetime(f"{base_d} 13:30:00")
+    if chart_data is None or chart_data.empty or base_d == "":
+        base_d = base_d or datetime.now().strftime("%Y-%m-%d")
         chart_data = pd.DataFrame()
-    else:
-        start = pd.to_datetime(f"{base_d} 09:00:00")
-        end = pd.to_datetime(f"{base_d} 13:30:00")
-        chart_data['DT'] = pd.to_datetime(chart_data['Date'] + ' ' + chart_data['Time'], errors='coerce')
-        chart_data = chart_data.dropna(subset=['DT'])
-        chart_data['T_S'] = (chart_data['Taiex_Change']*10)+0.5
+    start = pd.to_datetime(f"{base_d} 09:00:00")
+    end = pd.to_datetime(f"{base_d} 13:30:00")
+    if not chart_data.empty:
+        chart_data = chart_data.assign(DT=start.normalize() + pd.to_timedelta(chart_data['Min'], unit='m'),
+                                       T_S=chart_data['Taiex_Change'] * 10 + 0.5)
 
     x_scale = alt.Scale(domain=[start, end])
     y_vals = [0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0]
@@ -649,28 +2109,231 @@ def plot_chart():
     layers = []
     rule_r = alt.Chart(pd.DataFrame({'y':[BREADTH_THR]})).mark_rule(color='red', strokeDash=[5,5]).encode(y='y')
     rule_g = alt.Chart(pd.DataFrame({'y':[BREADTH_LOW]})).mark_rule(color='green', strokeDash=[5,5]).encode(y='y')
+
+    prev = [p for p in prev if p is not None and not p.empty]
+    if prev:
+        ov = pd.concat(prev, ignore_index=True)
+        ov['DT'] = start.normalize() + pd.to_timedelta(ov['Min'], unit='m')
+        layers.append(alt.Chart(ov).mark_line(strokeWidth=1, opacity=0.6).encode(
+            x=alt.X('DT:T', title=None, axis=alt.Axis(format='%H:%M'), scale=x_scale),
+            y=alt.Y('Breadth', title=None, scale=alt.Scale(domain=[0,1], nice=False), axis=y_axis),
+            color=alt.Color('Date:N', scale=alt.Scale(scheme='greys', reverse=True), legend=alt.Legend(title=None, orient='bottom')),
+            tooltip=['Date', alt.Tooltip('DT', format='%H:%M'), alt.Tooltip('Breadth', format='.1%')]))
     
     if not chart_data.empty:
         l_b = base.mark_line(color='#ffc107').encode(y=alt.Y('Breadth', title=None, scale=alt.Scale(domain=[0,1], nice=False), axis=y_axis))
         p_b = base.mark_circle(color='#ffc107', size=20).encode(y='Breadth', tooltip=['DT', alt.Tooltip('Breadth', format='.1%')])
         l_t = base.mark_line(color='#007bff', strokeDash=[4,4]).encode(y=alt.Y('T_S', scale=alt.Scale(domain=[0,1])))
         p_t = base.mark_circle(color='#007bff', size=20).encode(y='T_S', tooltip=['DT', alt.Tooltip('Taiex_Change', format='.2%')])
-        layers = [l_b, p_b, l_t, p_t, rule_r, rule_g]
+        layers += [l_b, p_b, l_t, p_t, rule_r, rule_g]
     else:
-        layers = [base, rule_r, rule_g]
+        layers += [base, rule_r, rule_g]
 
     return alt.layer(*layers).properties(height=400, title=f"走勢對照 - {base_d}").resolve_scale(y='shared')
 
-def fetch_all():
+# ==========================================
+# 廣度計算引擎 (向量化)
+# ==========================================
+def tail_closes(arr, k):
+    """
+    每欄取最後 k 筆有效收盤 (等同逐檔 dropna().tail(k))，不足者補 NaN
+    回傳 (k x N 矩陣, 每欄有效筆數)
+    """
+    valid = ~np.isnan(arr)
+    cnt = valid.sum(axis=0)
+    if arr.shape[0] < k:
+        pad = np.full((k - arr.shape[0], arr.shape[1]), np.nan)
+        arr = np.vstack([pad, arr]); valid = ~np.isnan(arr)
+    order = np.argsort(valid, axis=0, kind='stable')
+    packed = np.take_along_axis(arr, order, axis=0)
+    return packed[-k:], cnt
+
+class BreadthState:
+    """
+    單日 MA5 增量狀態: 前 4 日收盤和與翻多門檻價 (四日均價，現價高於即站上含現價的 MA5)
+    每日只算一次；之後每筆報價 O(1) 更新該檔狀態與前 head 檔的站上 / 有效家數
+    """
+    def __init__(self, mat, codes, today_str, head=None):
+        n = len(codes)
+        self.codes = list(codes); self.pos = {c: i for i, c in enumerate(self.codes)}
+        self.head = n if head is None else min(head, n)
+        self.lock = threading.Lock()
+        arr = mat.reindex(columns=self.codes).to_numpy(dtype=float) if not mat.empty else np.full((0, n), np.nan)
+
+        has_today = np.zeros(n, dtype=bool)
+        arr_ex = arr
+        if len(arr) and str(mat.index[-1]) == today_str:
+            has_today = ~np.isnan(arr[-1])
+            arr_ex = arr[:-1]
+
+        last2, cnt = tail_closes(arr, 2)
+        hist_p = np.where(has_today & (cnt >= 2), last2[0], last2[1])
+        self.hist_p = np.where(cnt >= 1, hist_p, 0.0)
+        self.cnt = cnt
+
+        last5_ex, cnt_ex = tail_closes(arr_ex, 5)
+        self.p_ma5 = np.where(cnt_ex >= 5, np.nansum(last5_ex, axis=0) / 5, 0.0)
+
+        last4, _ = tail_closes(arr, 4)
+        self.sum4 = np.nansum(last4, axis=0)
+        self.thr = np.where(cnt >= 4, self.sum4 / 4, np.nan)
+
+        self.curr = np.zeros(n); self.y = np.zeros(n)
+        self.p_price = self.hist_p.copy()
+        self.p_ok = (cnt >= 1) & (self.p_price > 0)
+        self.p_above = self.p_ok & (self.p_price > self.p_ma5)
+        self.c_ma5 = np.zeros(n); self.c_valid = np.zeros(n, dtype=bool); self.c_above = np.zeros(n, dtype=bool)
+        self.h = 0; self.v = 0
+
+    def set(self, i, price, y):
+        if price == self.curr[i] and y == self.y[i]: return False
+        self.curr[i] = price; self.y[i] = y
+        pp = y if y > 0 else self.hist_p[i]
+        ok = bool(self.cnt[i] >= 1 and pp > 0)
+        self.p_price[i] = pp; self.p_ok[i] = ok; self.p_above[i] = ok and pp > self.p_ma5[i]
+        valid = bool(price > 0 and pp > 0 and self.cnt[i] >= 4)
+        ma5 = (self.sum4[i] + price) / 5 if valid else 0.0
+        above = valid and price > ma5
+        if i < self.head:
+            self.h += int(above) - int(self.c_above[i]); self.v += int(valid) - int(self.c_valid[i])
+        self.c_valid[i] = valid; self.c_above[i] = above; self.c_ma5[i] = ma5
+        return True
+
+    def update(self, code, price, y=0.0):
+        """
+        單筆報價 (串流 callback 用)；不在名單內的代號略過
+        """
+        i = self.pos.get(code)
+        if i is None: return False
+        with self.lock: return self.set(i, float(price), float(y))
+
+    def apply(self, curr_p, real_y):
+        """
+        整批報價 (順序同 codes)；只逐檔更新有變動的，回傳變動檔數
+        """
+        curr_p = np.asarray(curr_p, dtype=float); real_y = np.asarray(real_y, dtype=float)
+        with self.lock:
+            chg = np.flatnonzero((curr_p != self.curr) | (real_y != self.y))
+            for i in chg: self.set(i, curr_p[i], real_y[i])
+        return len(chg)
+
+    def engine(self):
+        """
+        目前狀態 (站上 / 有效遮罩、MA5、翻多價與家數；陣列為複本，之後的更新不影響)
+        """
+        with self.lock:
+            out = {k: getattr(self, k).copy() for k in ("p_price", "p_ma5", "p_ok", "p_above", "c_ma5", "c_valid", "c_above", "thr")}
+            out['h'] = int(out['c_above'].sum()); out['v'] = int(out['c_valid'].sum())
+        return out
+
+@st.cache_resource
+def get_breadth_slot():
+    return {"key": None, "state": None, "lock": threading.Lock()}
+
+def breadth_state(mat, codes, today_str, head):
+    """
+    當日共用的 BreadthState；交易日、名單或收盤矩陣的最後一列改變才重建
+    """
+    slot = get_breadth_slot()
+    key = (today_str, tuple(codes), head, str(mat.index[-1]) if len(mat) else "", mat.shape)
+    with slot["lock"]:
+        hit = slot["key"] == key
+        get_metrics().cache("breadth_state", hit)
+        if not hit: slot.update(key=key, state=BreadthState(mat, codes, today_str, head))
+        return slot["state"]
+
+def calc_prev_breadth(mat, codes, date_prev):
+    """
+    昨日廣度: date_prev 收盤是否站上含當日的 5 日均線
+    """
+    if mat.empty or date_prev not in mat.index: return 0, 0
+    r = mat.index.get_loc(date_prev)
+    arr = mat.reindex(columns=codes).to_numpy(dtype=float)[:r+1]
+    last5, cnt = tail_closes(arr, 5)
+    ok = ~np.isnan(arr[-1]) & (cnt >= 5)
+    above = ok & (arr[-1] > np.nansum(last5, axis=0) / 5)
+    return int(above.sum()), int(ok.sum())
+
+def breadth_table(codes, eng, curr_p, info_map, src_notes, reasons):
+    """
+    明細表 (dtls) 以欄為單位組成
+    """
+    m_display = pd.Series(codes).map(info_map).map({"twse":"上市", "tpex":"上櫃", "emerging":"興櫃"}).fillna("未知")
+    curr_p = np.asarray(curr_p, dtype=float)
+    p_price = pd.Series(eng['p_price']).astype(str)
+    base = "昨收" + p_price
+    note = pd.Series(np.where(curr_p == 0, "⚠️" + pd.Series(reasons) + " | " + base, base))
+    src = pd.Series(src_notes)
+    note = np.where(src != "", "📝" + src + " " + note, note)
+    p_stt = np.where(eng['p_ok'], np.where(eng['p_above'], "✅", "📉"), "-")
+    c_stt = np.where(curr_p == 0, "⚠️無報價", np.where(eng['c_valid'], np.where(eng['c_above'], "✅", "📉"), "-"))
+    return pd.DataFrame({
+        "代號": codes, "市場": m_display.values,
+        "昨收": eng['p_price'], "昨MA5": np.round(eng['p_ma5'], 2), "昨狀態": p_stt,
+        "現價": curr_p, "今MA5": np.round(eng['c_ma5'], 2), "翻多價": np.round(eng['thr'], 2), "今狀態": c_stt,
+        "備註": note
+    })
+
+def market_codes(mat):
+    """
+    全市場普通股代號 (最後交易日有收盤，規則同 get_ranks_strict)
+    """
+    if mat.empty: return []
+    last = mat.iloc[-1]
+    ids = pd.Index(last.index[last.notna()].astype(str))
+    ok = (ids.str.len() == 4) & ids.str.isdigit()
+    for p in EXCL_PFX: ok &= ~ids.str.startswith(p)
+    return ids[ok].tolist()
+
+def universe_breadth(codes, eng, ranks, info):
+    """
+    多族群廣度: 一次計算好的站上/有效遮罩，依族群分組加總
+    固定族群用索引陣列，產業別用 bincount 一次分組
+    """
+    above = eng['c_above'].astype(float); valid = eng['c_valid'].astype(float)
+    pos = {c: i for i, c in enumerate(codes)}
+    groups = []
+    for n in UNIVERSE_TOPS:
+        groups.append((f"成交值前{n}", np.array([pos[c] for c in ranks[:n] if c in pos], dtype=int)))
+    info = info.set_index('stock_id').reindex(codes)
+    m_type = info['type'].fillna("").to_numpy()
+    groups.append(("上市全部", np.flatnonzero(m_type == "twse")))
+    groups.append(("上櫃全部", np.flatnonzero(m_type == "tpex")))
+    rows = [(name, int(above[idx].sum()), int(valid[idx].sum())) for name, idx in groups]
+
+    ind = info['industry_category'].fillna("").astype(str)
+    gid, names = pd.factorize(ind)
+    h = np.bincount(gid[gid >= 0], weights=above[gid >= 0], minlength=len(names))
+    v = np.bincount(gid[gid >= 0], weights=valid[gid >= 0], minlength=len(names))
+    rows += [(f"產業:{n}", int(h[i]), int(v[i])) for i, n in enumerate(names) if n and v[i] > 0]
+
+    df = pd.DataFrame(rows, columns=["族群", "站上", "有效"])
+    df["廣度"] = np.where(df["有效"] > 0, df["站上"] / df["有效"].clip(lower=1), 0.0)
+    return df
+
+def slice_engine(eng, n):
+    out = {k: (v[:n] if isinstance(v, np.ndarray) else v) for k, v in eng.items()}
+    out['h'] = int(out['c_above'].sum()); out['v'] = int(out['c_valid'].sum())
+    return out
+
+def stream_prices(sj_api, ranks_curr, ranks_prev, all_targets):
+    book = get_quote_book()
+    book.attach(sj_api)
+    book.sync(ranks_curr + [c for c in ranks_prev if c not in ranks_curr])
+    return book.prices(all_targets)
+
+def fetch_all(stream=False, multi=False):
+    mt = get_metrics(); mt.begin()
+    tape = get_tape(); tape.mark(datetime.now(timezone(timedelta(hours=8))), stream=stream, multi=multi)
     ft = get_finmind_token()
-    sj_api, sj_err = get_api() 
-    days = get_days(ft)
+    with mt.stage("login"): sj_api, sj_err = get_api()
+    with mt.stage("days", cached=True): days = get_days(ft)
     
     now = datetime.now(timezone(timedelta(hours=8)))
     today_str = now.strftime("%Y-%m-%d")
     if not days: days = [today_str]
     
-    info_map = get_stock_info_map(ft)
+    with mt.stage("info_map"): info_map = get_stock_info_map(ft)
     
     d_cur = days[-1]
     is_intra = (time(8,45)<=now.time()<time(13,30)) and (0<=now.weekday()<=4)
@@ -681,18 +2344,28 @@ def fetch_all():
     else:
         date_prev = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
     
-    ranks_prev, _ = get_ranks_strict(ft, date_prev) 
+    with mt.stage("ranks"):
+        backfill_ranks(ft, [d for d in days[:-1] if d < today_str])
+        ranks_prev, _ = get_ranks_strict(ft, date_prev) 
     
-    ranks_curr = ranks_prev 
-    msg_src = f"名單:{date_prev}(昨日/盤中)"
+        ranks_curr = ranks_prev 
+        msg_src = f"名單:{date_prev}(昨日/盤中)"
     
-    if now.time() >= time(14, 0) and d_cur == today_str:
-        ranks_today, _ = get_ranks_strict(ft, today_str, min_count=1500)
-        if ranks_today:
-            ranks_curr = ranks_today
-            msg_src = f"名單:{today_str}(今日完整)"
+        if now.time() >= time(14, 0) and d_cur == today_str:
+            ranks_today, _ = get_ranks_strict(ft, today_str, min_count=FULL_MARKET_MIN)
+            if ranks_today:
+                ranks_curr = ranks_today
+                msg_src = f"名單:{today_str}(今日完整)"
     
-    all_targets = list(set(ranks_curr + ranks_prev))
+    s_dt = (datetime.now()-timedelta(days=40)).strftime("%Y-%m-%d")
+    with mt.stage("close_matrix", cached=True): mat = get_close_matrix(ft, s_dt)
+    rank_set = set(ranks_curr)
+    codes = list(ranks_curr) + ([c for c in market_codes(mat) if c not in rank_set] if multi else [])
+
+    all_targets = list(set(codes + ranks_prev))
+    with mt.stage("breadth_state"): bstate = breadth_state(mat, codes, today_str, len(ranks_curr))
+    if stream: get_quote_book().state = bstate
+    else: get_quote_book().detach()
 
     pmap = {}
     mis_debug_map = {} 
@@ -701,142 +2374,69 @@ def fetch_all():
     last_t = "無即時資料"
     api_status_code = 0 
     sj_usage_info = "無資料"
+    source_health = None
     
     is_post_market = (now.time() >= time(14, 0))
     
     if allow_live_fetch:
-        if sj_api:
-            try:
-                usage = sj_api.usage(); sj_usage_info = str(usage) if usage else "無法取得"
-                contracts = []
-                for c in all_targets: 
-                    if c in sj_api.Contracts.Stocks: contracts.append(sj_api.Contracts.Stocks[c])
-                
-                if contracts:
-                    for i in range(0, len(contracts), 50):
-                        chunk = contracts[i:i+50]
-                        snaps = sj_api.snapshots(chunk)
-                        for s in snaps:
-                            if s.close > 0:
-                                pmap[s.code] = {
-                                    'price': float(s.close),
-                                    'y_close': float(s.reference_price) 
-                                }
-                        time_module.sleep(0.2)
-                    
+        if sj_api and stream:
+            with mt.stage("stream"):
+                try:
+                    pmap.update(tape.call("stream", "prices", lambda: stream_prices(sj_api, ranks_curr, ranks_prev, all_targets)))
+                    mt.cache("stream", True, len(pmap)); mt.cache("stream", False, len(all_targets) - len(pmap))
                     if len(pmap) > 0:
-                        data_source = "永豐API"
+                        data_source = "永豐串流"
                         last_t = datetime.now(timezone(timedelta(hours=8))).strftime("%H:%M:%S")
                         api_status_code = 2
-            except: pass
-        
+                except: mt.error("stream")
+
+        qs = get_quote_sources()
+        if sj_api: sj_usage_info = qs.usage(sj_api)
         missing_codes = [c for c in all_targets if c not in pmap]
         if missing_codes:
-            mis_data, debug_log = get_prices_twse_mis(missing_codes, info_map)
-            mis_debug_map = debug_log 
-
-            for c, val in mis_data.items():
-                pmap[c] = val
-            
-            if len(mis_data) > 0 and data_source == "歷史":
-                data_source = "證交所MIS"
+            with mt.stage("quotes"): q = qs.fetch(missing_codes, sj_api, info_map)
+            pmap.update(q["px"])
+            mis_debug_map = q["why"]
+            won = {k: v for k, v in q["won"].items() if v > 0}
+            if won and data_source == "歷史":
+                data_source = QuoteSources.NAMES[max(won, key=won.get)]
                 last_t = datetime.now(timezone(timedelta(hours=8))).strftime("%H:%M:%S")
                 api_status_code = 2
+            if q["degraded"]: api_status_code = 1
+        source_health = qs.table()
 
     if is_post_market:
         if data_source == "歷史": 
              data_source = "FinMind盤後"
              last_t = "13:30:00"
 
-    s_dt = (datetime.now()-timedelta(days=40)).strftime("%Y-%m-%d")
-    h_c, v_c = 0, 0
-    dtls = []
-    
-    for c in ranks_curr:
-        df = get_hist(ft, c, s_dt) 
-        m_type = info_map.get(c, "未知")
-        m_display = {"twse":"上市", "tpex":"上櫃", "emerging":"興櫃"}.get(m_type, "未知")
-        
-        info = pmap.get(c, {})
-        curr_p = info.get('z', info.get('price', 0)) 
-        real_y = info.get('y', info.get('y_close', 0)) 
-        
-        p_price = 0
-        if real_y > 0: 
-            p_price = real_y
-        elif not df.empty:
-            if df.iloc[-1]['date'] == today_str and len(df) >= 2:
-                 p_price = float(df.iloc[-2]['close'])
-            else:
-                 p_price = float(df.iloc[-1]['close']) 
+    infos = [pmap.get(c, {}) for c in codes]
+    curr_p = [info.get('z', info.get('price', 0)) for info in infos]
+    real_y = [info.get('y', info.get('y_close', 0)) for info in infos]
+    src_notes = [info.get('note', '') for info in infos]
+    reasons = [mis_debug_map.get(c, "非交易時間" if not allow_live_fetch else "無來源回傳") for c in codes]
 
-        p_ma5 = 0
-        p_stt = "-"
-        
-        if not df.empty and p_price > 0:
-            closes = []
-            if df.iloc[-1]['date'] == today_str:
-                closes = df['close'].iloc[:-1].tail(5).tolist() 
-            else:
-                closes = df['close'].tail(5).tolist()
-            if len(closes) >= 5:
-                p_ma5 = sum(closes[-5:]) / 5
-            if p_price > p_ma5: p_stt="✅"
-            else: p_stt="📉"
-
-        c_ma5 = 0
-        c_stt = "-"
-        note = ""
-        
-        if curr_p == 0: 
-            c_stt = "⚠️無報價"
-            reason = mis_debug_map.get(c, "非交易時間" if not allow_live_fetch else "MIS未回傳")
-            note = f"⚠️{reason} | 昨收{p_price}"
-        else: note = f"昨收{p_price}"
-        
-        source_note = info.get('note', '')
-        if source_note: note = f"📝{source_note} " + note
-
-        if curr_p > 0 and p_price > 0 and not df.empty:
-            hist_closes = df['close'].tail(4).tolist()
-            if len(hist_closes) >= 4:
-                ma5_input = hist_closes + [curr_p]
-                c_ma5 = sum(ma5_input) / 5
-                if curr_p > c_ma5: h_c += 1; c_stt="✅"
-                else: c_stt="📉"
-                v_c += 1
-        
-        dtls.append({
-            "代號":c, "市場": m_display,
-            "昨收":p_price, "昨MA5":round(p_ma5,2), "昨狀態":p_stt,
-            "現價":curr_p, "今MA5":round(c_ma5,2), "今狀態":c_stt,
-            "備註": note
-        })
-
-    h_p, v_p = 0, 0
-    for c in ranks_prev:
-        df = get_hist(ft, c, s_dt)
-        if df.empty: continue
-        
-        try:
-            df_prev = df[df['date'] == date_prev]
-            if not df_prev.empty:
-                idx = df.index.get_loc(df_prev.index[0])
-                if idx >= 4:
-                    prev_c = float(df_prev.iloc[0]['close'])
-                    prev_m = df['close'].iloc[idx-4:idx+1].mean()
-                    if prev_c > prev_m: h_p += 1
-                    v_p += 1
-        except: pass
+    with mt.stage("engine"):
+        changed = bstate.apply(curr_p, real_y)
+        mt.cache("engine", True, len(codes) - changed); mt.cache("engine", False, changed)
+        eng_all = bstate.engine()
+        n = len(ranks_curr)
+        eng = slice_engine(eng_all, n) if len(codes) > n else eng_all
+        h_c, v_c = eng['h'], eng['v']
+        dtls = breadth_table(codes[:n], eng, curr_p[:n], info_map, src_notes[:n], reasons[:n])
+        uni = universe_breadth(codes, eng_all, list(ranks_curr), get_stock_info_table(ft)) if multi else None
+
+        h_p, v_p = calc_prev_breadth(mat, list(ranks_prev), date_prev)
 
     br_c = h_c/v_c if v_c>0 else 0
     br_p = h_p/v_p if v_p>0 else 0
     
     t_cur, t_pre, slope = 0, 0, 0
+    t0_tw = time_module.perf_counter()
     try:
-        tw = get_hist(ft, "TAIEX", s_dt)
+        tw = mat_hist(mat, "TAIEX")
         if not tw.empty:
-            mis_tw, _ = get_prices_twse_mis(["t00"], {"t00":"twse"}) 
+            mis_tw = get_quote_sources().fetch(["t00"], None, {"t00": "twse"})["px"]
             t_curr = mis_tw.get("t00", {}).get("z", 0)
             
             if tw.iloc[-1]['date'] == today_str:
@@ -860,29 +2460,544 @@ def fetch_all():
                 ma5_curr = sum(closes_for_curr) / 5
                 slope = ma5_curr - ma5_prev
             
-    except: pass
+    except: mt.error("taiex")
+    mt.add("taiex", calls=1, sec=time_module.perf_counter() - t0_tw)
     
     if t_cur == t_pre: t_chg = 0
     else: t_chg = (t_cur-t_pre)/t_pre if t_pre>0 else 0
     
     rec_t = last_t if is_intra and "無" not in str(last_t) else ("13:30:00" if is_post_market else datetime.now(timezone(timedelta(hours=8))).strftime("%H:%M:%S"))
     
-    save_rec(d_cur, rec_t, br_c, t_chg, t_cur, t_pre, is_intra, v_c)
+    with mt.stage("save_rec"): save_rec(d_cur, rec_t, br_c, t_chg, t_cur, t_pre, is_intra, v_c)
     
-    chips_data, chips_diag = get_chips_data(ft, d_cur)
+    with mt.stage("chips", cached=True): chips_data, chips_diag = get_chips_data(ft, d_cur)
     chip_strategy = get_chip_strategy(slope, chips_data)
+    timing = mt.end(d_cur)
     
     return {
         "d":d_cur, "d_prev": date_prev, 
         "br":br_c, "br_p":br_p, "h":h_c, "v":v_c, "h_p":h_p, "v_p":v_p,
-        "df":pd.DataFrame(dtls), 
+        "df":dtls, 
         "t":last_t, "tc":t_chg, "slope":slope, "src_type": data_source,
         "raw":{'Date':d_cur,'Time':rec_t,'Breadth':br_c}, "src":msg_src,
         "api_status": api_status_code, "sj_err": sj_err, "sj_usage": sj_usage_info,
         "chip_strat": chip_strategy,
-        "chip_diag": chips_diag 
+        "chip_diag": chips_diag,
+        "uni": uni, "timing": timing, "health": source_health
     }
 
+# ==========================================
+# 回測 (向量化)
+# ==========================================
+def load_history_frame(start=None):
+    """
+    讀取全部 (或 start 之後) 交易日分檔為單一 DataFrame
+    """
+    hist = get_history()
+    parts = []
+    for d in hist.dates():
+        if start and d < start: continue
+        try: parts.append(pd.read_csv(hist.part(d), dtype={'Date': str, 'Time': str}))
+        except: pass
+    if not parts: return pd.DataFrame(columns=HIST_COLS)
+    df = pd.concat(parts, ignore_index=True)
+    if 'Total' not in df.columns: df['Total'] = 0
+    return df[HIST_COLS]
+
+def summarize_trades(trades):
+    if trades.empty:
+        return pd.DataFrame(columns=["訊號", "次數", "勝率", "平均損益%", "累計點數"])
+    g = trades.groupby("訊號", sort=False)
+    return pd.DataFrame({
+        "次數": g.size(),
+        "勝率": g["損益點數"].apply(lambda x: (x > 0).mean()),
+        "平均損益%": g["損益%"].mean() * 100,
+        "累計點數": g["損益點數"].sum(),
+    }).reset_index()
+
+def run_backtest(hist, tw, open_thr=OPEN_DEV_THR, swing_thr=SWING_THR):
+    """
+    以歷史廣度/加權指數重播盤中規則 (全部交易日一次向量化):
+      趨勢鎖定: 廣度先達開盤 ±open_thr 的方向
+      高點回落: 鎖定偏多 + MA5斜率>0 + 廣度自當日高點回落 swing_thr ➜ 作多
+      低點反彈: 鎖定偏空 + MA5斜率<0 + 廣度自當日低點反彈 swing_thr ➜ 作空
+    皆以訊號當下指數進場、當日最後一筆出場；另以收盤 MA5 斜率回測隔日方向
+    回傳 (績效摘要, 逐筆交易)
+    """
+    df = hist.copy()
+    df['Date'] = df['Date'].astype(str); df['Time'] = df['Time'].astype(str).str[:5]
+    df = df[df['Taiex_Current'] > 0].sort_values(['Date', 'Time']).reset_index(drop=True)
+    tw = tw.copy(); tw['date'] = tw['date'].astype(str)
+    tw = tw.drop_duplicates('date', keep='last').sort_values('date').reset_index(drop=True)
+    if df.empty or tw.empty: return summarize_trades(pd.DataFrame()), pd.DataFrame()
+
+    # MA5 斜率 = (目前指數 - 5 個交易日前收盤) / 5
+    t_dates = tw['date'].to_numpy(dtype=str); t_close = tw['close'].to_numpy(dtype=float)
+    pos5 = np.searchsorted(t_dates, df['Date'].to_numpy(dtype=str), side='left') - 5
+    c5 = np.where(pos5 >= 0, t_close[np.clip(pos5, 0, None)], np.nan)
+    slope = (df['Taiex_Current'].to_numpy() - c5) / 5
+
+    key = df['Date']
+    br = df['Breadth']
+    ok_open = (df['Time'] >= "09:00") & (df['Total'] >= OPEN_COUNT_THR)
+    has_open = ok_open.groupby(key).cummax()
+    open_b = br.where(ok_open).groupby(key).transform('first')
+    seq = df.groupby(key).cumcount()
+    up = has_open & (br >= open_b + open_thr)
+    dn = has_open & (br <= open_b - open_thr)
+    first_up = seq.where(up).groupby(key).transform('min').fillna(np.inf)
+    first_dn = seq.where(dn).groupby(key).transform('min').fillna(np.inf)
+    trend_up = (first_up < first_dn) & (seq >= first_up)
+    trend_dn = (first_dn < first_up) & (seq >= first_dn)
+
+    drop_high = br <= br.groupby(key).cummax() - swing_thr
+    rise_low = br >= br.groupby(key).cummin() + swing_thr
+    exit_px = df['Taiex_Current'].groupby(key).transform('last')
+
+    sigs = {
+        "趨勢鎖定偏多": (trend_up & (seq == first_up), 1),
+        "趨勢鎖定偏空": (trend_dn & (seq == first_dn), -1),
+        "高點回落作多": (trend_up & (slope > 0) & drop_high, 1),
+        "低點反彈作空": (trend_dn & (slope < 0) & rise_low, -1),
+    }
+    trades = []
+    for name, (mask, side) in sigs.items():
+        first = mask & ~mask.groupby(key).shift(fill_value=False).groupby(key).cummax()
+        t = df.loc[first, ['Date', 'Time', 'Breadth', 'Taiex_Current']].copy()
+        t['出場'] = exit_px[first]
+        t['損益點數'] = (t['出場'] - t['Taiex_Current']) * side
+        t['損益%'] = t['損益點數'] / t['Taiex_Current']
+        t['訊號'] = name
+        trades.append(t)
+
+    # 收盤 MA5 斜率 ➜ 隔日方向
+    ma5 = pd.Series(t_close).rolling(5).mean()
+    d_slope = ma5.diff()
+    nxt = pd.Series(t_close).shift(-1) - pd.Series(t_close)
+    side = np.sign(d_slope)
+    t = pd.DataFrame({'Date': t_dates, 'Time': "13:30", 'Breadth': np.nan, 'Taiex_Current': t_close,
+                      '出場': pd.Series(t_close).shift(-1), '損益點數': nxt * side, '損益%': nxt * side / t_close,
+                      '訊號': np.where(side > 0, "MA5斜率正➜隔日多", "MA5斜率負➜隔日空")})
+    trades.append(t[(side.fillna(0) != 0) & nxt.notna()])
+
+    trades = pd.concat(trades, ignore_index=True).sort_values(['Date', 'Time']).reset_index(drop=True)
+    trades = trades.rename(columns={'Date': '日期', 'Time': '時間', 'Breadth': '廣度', 'Taiex_Current': '進場'})
+    return summarize_trades(trades), trades
+
+def run_backtest_cli():
+    """
+    python streamlit_app.py backtest [起始日]
+    """
+    start = sys.argv[2] if len(sys.argv) > 2 else "2000-01-01"
+    hist = load_history_frame(start)
+    tw = get_hist(get_finmind_token(), "TAIEX", start)
+    summary, trades = run_backtest(hist, tw)
+    print(f"盤中樣本 {len(hist)} 筆 / {hist['Date'].nunique()} 日，指數 {len(tw)} 日")
+    print(summary.to_string(index=False))
+
+# ==========================================
+# 歷史廣度回補 (多行程)
+# ==========================================
+def backfill_year(token, dates, lookback, tw_pairs):
+    """
+    單一年度: 每日以當日成交值前 TOP_N 為名單，算收盤站上 MA5 的廣度
+    lookback 為前一年度最後 4 個交易日 (MA5 需要)，tw_pairs 為 date -> (收盤, 前一日收盤)
+    """
+    cols = {}
+    ranks = {}
+    for d in lookback + dates:
+        df = load_market_day(token, d)
+        if df.empty: continue
+        cols[d] = market_close_series(df)
+        if d in dates: ranks[d] = rank_market_day(df)[0]
+    if not cols: return []
+    mat = pd.DataFrame(cols).T.reindex([d for d in lookback + dates if d in cols])
+    rows = []
+    for d in dates:
+        if not ranks.get(d): continue
+        h, v = calc_prev_breadth(mat, ranks[d], d)
+        if v == 0: continue
+        t_cur, t_pre = tw_pairs.get(d, (0, 0))
+        rows.append({'Date': d, 'Time': "13:30", 'Breadth': h / v,
+                     'Taiex_Change': (t_cur - t_pre) / t_pre if t_pre > 0 else 0,
+                     'Taiex_Current': t_cur, 'Taiex_Prev_Close': t_pre, 'Total': v})
+    return rows
+
+def backfill_breadth(token, start_year, end_year, workers=BACKFILL_WORKERS, overwrite=False):
+    """
+    依年度分給行程池重建每日收盤廣度，寫入廣度歷史 (已有盤中紀錄的日子預設不覆蓋)
+    """
+    tw = sync_index_hist(token, f"{start_year - 1}-12-01")
+    if tw.empty: return 0
+    t_dates = tw['date'].astype(str).tolist(); t_close = tw['close'].astype(float).tolist()
+    jobs = []
+    for y in range(start_year, end_year + 1):
+        idx = [i for i, d in enumerate(t_dates) if d[:4] == str(y)]
+        if not idx: continue
+        pairs = {t_dates[i]: (t_close[i], t_close[i - 1] if i > 0 else 0) for i in idx}
+        jobs.append(([t_dates[i] for i in idx], t_dates[max(0, idx[0] - 4):idx[0]], pairs))
+
+    hist = get_history()
+    have = set(hist.dates())
+    n = 0
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        futs = {ex.submit(backfill_year, token, ys, lb, tp): ys[0][:4] for ys, lb, tp in jobs}
+        for fut in as_completed(futs):
+            try: rows = fut.result()
+            except Exception as e:
+                print(f"{futs[fut]} 失敗: {e}"); continue
+            for r in rows:
+                if r['Date'] in have and not overwrite: continue
+                os.makedirs(hist.root, exist_ok=True)
+                hist.write_day(r['Date'], [r]); n += 1
+            print(f"{futs[fut]}: {len(rows)} 日")
+    hist.date_list = None
+    return n
+
+def run_backfill_cli():
+    """
+    python streamlit_app.py backfill 起始年 [結束年] [--overwrite]
+    """
+    args = [a for a in sys.argv[2:] if not a.startswith("--")]
+    start_year = int(args[0]) if args else datetime.now().year
+    end_year = int(args[1]) if len(args) > 1 else datetime.now().year
+    n = backfill_breadth(get_finmind_token(), start_year, end_year, overwrite="--overwrite" in sys.argv)
+    print(f"完成，寫入 {n} 個交易日")
+
+# ==========================================
+# 盤中重播 (永豐 1 分 K)
+# ==========================================
+def kbar_path(d):
+    return os.path.join(KBAR_DIR, f"{d}.parquet")
+
+def fetch_kbars(api, codes, d):
+    """
+    分批同時抓取 1 分 K (限速 KBAR_RATE 次/秒)，回傳 code, ts, close 長表
+    """
+    bucket = TokenBucket(KBAR_RATE, KBAR_RATE)
+    def one(c):
+        contract = api.Contracts.Indexs.TSE["001"] if c == "TSE001" else api.Contracts.Stocks[c]
+        if contract is None: return None
+        bucket.acquire()
+        try:
+            kb = api.kbars(contract=contract, start=d, end=d)
+            df = pd.DataFrame({'ts': pd.to_datetime(kb.ts), 'close': kb.Close})
+        except: return None
+        df['code'] = c
+        return df
+    with ThreadPoolExecutor(max_workers=KBAR_WORKERS) as ex:
+        parts = [p for p in ex.map(one, codes) if p is not None and not p.empty]
+    if not parts: return pd.DataFrame(columns=['code', 'ts', 'close'])
+    return pd.concat(parts, ignore_index=True)[['code', 'ts', 'close']]
+
+def load_kbars(api, codes, d):
+    """
+    本地快取優先，只補抓快取中沒有的代號
+    """
+    cached = None
+    if os.path.exists(kbar_path(d)):
+        try: cached = pd.read_parquet(kbar_path(d))
+        except: cached = None
+    have = set(cached['code'].unique()) if cached is not None else set()
+    missing = [c for c in codes if c not in have]
+    if missing and api is not None:
+        new = fetch_kbars(api, missing, d)
+        if not new.empty:
+            cached = new if cached is None else pd.concat([cached, new], ignore_index=True)
+            try:
+                os.makedirs(KBAR_DIR, exist_ok=True)
+                cached.to_parquet(kbar_path(d) + ".tmp", index=False)
+                os.replace(kbar_path(d) + ".tmp", kbar_path(d))
+            except: pass
+    if cached is None: return pd.DataFrame(columns=['code', 'ts', 'close'])
+    return cached[cached['code'].isin(codes)]
+
+def replay_day(token, d):
+    """
+    以 1 分 K 重建某日 09:00–13:30 的廣度與加權指數曲線 (欄位同廣度歷史)
+    名單沿用盤中規則: 前一交易日的成交值排行
+    """
+    tw = sync_index_hist(token, (datetime.strptime(d, "%Y-%m-%d") - timedelta(days=20)).strftime("%Y-%m-%d"))
+    tw = tw[tw['date'] < d]
+    if len(tw) < 5: return pd.DataFrame(columns=HIST_COLS), "指數日線不足"
+    date_prev = tw['date'].iloc[-1]
+    ranks, _ = get_ranks_strict(token, date_prev)
+    if not ranks: return pd.DataFrame(columns=HIST_COLS), f"{date_prev} 無排行"
+
+    sj_api, sj_err = get_api()
+    bars = load_kbars(sj_api, ranks + ["TSE001"], d)
+    if bars.empty: return pd.DataFrame(columns=HIST_COLS), sj_err or "無分K資料"
+
+    grid = pd.date_range(f"{d} 09:00", f"{d} 13:30", freq="1min")
+    px = bars.pivot_table(index='ts', columns='code', values='close', aggfunc='last')
+    px = px.reindex(px.index.union(grid)).ffill().reindex(grid)
+
+    mat = build_close_matrix(token, tw.tail(6))
+    hist = mat.reindex(columns=ranks).to_numpy(dtype=float)
+    last4, cnt = tail_closes(hist, 4)
+    thr = np.nansum(last4, axis=0) / 4          # 現價 > 四日均價 ⇔ 現價 > 含現價的 MA5
+    p = px.reindex(columns=ranks).to_numpy(dtype=float)
+    valid = (np.nan_to_num(p) > 0) & (cnt >= 4)
+    above = valid & (p > thr)
+    h = above.sum(axis=1); v = valid.sum(axis=1)
+
+    t_pre = float(tw['close'].iloc[-1])
+    t_cur = px['TSE001'].to_numpy(dtype=float) if 'TSE001' in px.columns else np.full(len(grid), np.nan)
+    out = pd.DataFrame({
+        'Date': d, 'Time': grid.strftime("%H:%M"),
+        'Breadth': np.where(v > 0, h / np.maximum(v, 1), np.nan),
+        'Taiex_Change': t_cur / t_pre - 1, 'Taiex_Current': t_cur, 'Taiex_Prev_Close': t_pre, 'Total': v,
+    })
+    return out.dropna(subset=['Breadth']).reset_index(drop=True), f"名單:{date_prev} / {len(ranks)} 檔"
+
+# ==========================================
+# 錄放帶重播 (離線重現某次取樣)
+# ==========================================
+class TapeApi:
+    """
+    重播用的永豐替身: 只有錄製過的代號合約，報價由錄放帶回放
+    """
+    def __init__(self, codes):
+        self.Contracts = SimpleNamespace(Stocks={c: SimpleNamespace(code=c) for c in codes})
+
+def tape_api(tape):
+    codes = set()
+    for k in tape.keys("sj"):
+        if k.startswith("snapshots:"): codes.update(k[len("snapshots:"):].split(","))
+    if not codes and not tape.keys("stream"): return None, "錄放帶無永豐紀錄"
+    return TapeApi(sorted(codes)), None
+
+def tape_clock(tape):
+    class TapeClock(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            now = tape.clock()
+            return now.astimezone(tz) if tz else now.replace(tzinfo=None)
+    return TapeClock
+
+def tape_workdir(d):
+    """
+    重播用暫存目錄: 只複製 d 之前的本地日線 / 排行 / 端點紀錄 (與錄製當時相同)，
+    廣度歷史、快照、通知與耗時紀錄都寫在暫存目錄
+    """
+    work = tempfile.mkdtemp(prefix="tape_")
+    if os.path.isdir(OHLC_DIR):
+        os.makedirs(os.path.join(work, OHLC_DIR))
+        for f in os.listdir(OHLC_DIR):
+            if f[:4].isdigit() and f.endswith(".parquet") and f[:-8] < d:
+                shutil.copy2(os.path.join(OHLC_DIR, f), os.path.join(work, OHLC_DIR, f))
+        tw = store_read("TAIEX")
+        if tw is not None:
+            tw[tw['date'].astype(str) < d].to_parquet(os.path.join(work, store_path("TAIEX")), index=False)
+        if os.path.exists(os.path.join(OHLC_DIR, "meta.json")):
+            shutil.copy2(os.path.join(OHLC_DIR, "meta.json"), os.path.join(work, OHLC_DIR, "meta.json"))
+    ranks = {k: v for k, v in load_rank_archive().items() if k < d}
+    if ranks:
+        with open(os.path.join(work, RANK_FILE), 'w') as f: json.dump(ranks, f, separators=(',', ':'))
+    if os.path.exists(ROUTE_FILE): shutil.copy2(ROUTE_FILE, os.path.join(work, ROUTE_FILE))
+    return work
+
+def replay_tape(path, speed=1.0, t_from="", t_to="", profile=False, keep=False):
+    """
+    逐個 sample 以錄製當時的時間、參數與回應呼叫 fetch_all (不連網)
+    speed 為時間倍率 (sample 間隔與各來源耗時都除以 speed，0 為不等待)
+    回傳 [(sample 時間, 耗時秒數, fetch_all 結果, cProfile 統計或 None)]
+    """
+    tape = get_tape()
+    samples = tape.load(path)
+    if not samples: return []
+    tape.speed = speed
+    cwd = os.getcwd()
+    work = tape_workdir(samples[0]["now"].strftime("%Y-%m-%d"))
+    g = globals(); saved = {k: g[k] for k in ("datetime", "get_api")}
+    out = []
+    try:
+        os.chdir(work)
+        st.cache_data.clear()
+        g["datetime"] = tape_clock(tape); g["get_api"] = lambda: tape_api(tape)
+        prev_t, wall = None, time_module.monotonic()
+        for i, smp in enumerate(samples):
+            hm = smp["now"].strftime("%H:%M")
+            if (t_from and hm < t_from) or (t_to and hm > t_to): continue
+            if prev_t is not None and speed > 0:
+                time_module.sleep(max(0, (smp["t"] - prev_t) / speed - (time_module.monotonic() - wall)))
+            prev_t, wall = smp["t"], time_module.monotonic()
+            tape.cue(i)
+            prof = None
+            t0 = time_module.perf_counter()
+            if profile:
+                import cProfile
+                prof = cProfile.Profile()
+                data = prof.runcall(fetch_all, **smp["flags"])
+            else: data = fetch_all(**smp["flags"])
+            out.append((smp["now"], time_module.perf_counter() - t0, data, prof))
+    finally:
+        g.update(saved)
+        tape.mode = None; tape.reels = {}; tape.latest = {}
+        os.chdir(cwd)
+        st.cache_data.clear()
+        if keep: print(f"暫存目錄: {work}")
+        else: shutil.rmtree(work, ignore_errors=True)
+    return out
+
+def run_tape_cli():
+    """
+    python streamlit_app.py tape [錄製檔或日期目錄] [--speed 1] [--from 10:00] [--to 10:05] [--profile] [--keep]
+    """
+    args = sys.argv[2:]
+    def opt(name, default):
+        i = args.index(name) if name in args else -1
+        return args[i + 1] if 0 <= i < len(args) - 1 else default
+    pos = [a for i, a in enumerate(args) if not a.startswith("--") and (i == 0 or args[i - 1] not in ("--speed", "--from", "--to"))]
+    path = pos[0] if pos else os.path.join(TAPE_DIR, datetime.now().strftime("%Y-%m-%d"))
+    if not os.path.exists(path):
+        print(f"找不到錄製檔: {path}"); return
+    res = replay_tape(path, float(opt("--speed", 1)), opt("--from", ""), opt("--to", ""),
+                      profile="--profile" in args, keep="--keep" in args)
+    if not res: print("錄製檔沒有任何 sample")
+    for now, sec, data, prof in res:
+        if isinstance(data, str):
+            print(f"{now:%H:%M:%S} {sec:.2f}s 失敗: {data}"); continue
+        print(f"{now:%H:%M:%S} {sec:.2f}s 廣度 {data['br']:.1%} ({data['h']}/{data['v']}) {data['src_type']}")
+        tb = StageMetrics.table(data.get("timing"))
+        if not tb.empty: print("\n".join("    " + l for l in tb.to_string(index=False).splitlines()))
+        if prof:
+            import pstats
+            pstats.Stats(prof).sort_stats("cumulative").print_stats(20)
+
+# ==========================================
+# 背景取樣 (與 Streamlit rerun 脫鉤)
+# ==========================================
+def is_sampling_hours(now=None):
+    now = now or datetime.now(timezone(timedelta(hours=8)))
+    return (time(8,45)<=now.time()<time(13,30)) and (0<=now.weekday()<=4)
+
+def save_snapshot(data, owner, bucket=None):
+    try:
+        tmp = SNAPSHOT_FILE + ".tmp"
+        with open(tmp, 'wb') as f:
+            pickle.dump({"owner": owner, "pid": os.getpid(), "ts": time_module.time(), "bucket": bucket, "data": data}, f)
+        os.replace(tmp, SNAPSHOT_FILE)
+    except: pass
+
+def load_snapshot():
+    try:
+        with open(SNAPSHOT_FILE, 'rb') as f: return pickle.load(f)
+    except: return None
+
+class Collector(threading.Thread):
+    """
+    取樣執行緒: 依固定排程呼叫 fetch_all，寫入歷史並保留最新結果
+    盤中每 COLLECT_SEC 秒 (串流模式 STREAM_REFRESH_SEC 秒)，盤外每 COLLECT_IDLE_SEC 秒
+    """
+    def __init__(self, owner="thread"):
+        super().__init__(daemon=True, name="breadth-collector")
+        self.owner = owner
+        self.stream = False
+        self.multi = False
+        self.tg = (None, None)
+        self.latest = None
+        self.ts = 0
+        self.err = None
+        self.wake = threading.Event()
+        self.done = threading.Condition()
+
+    def interval(self):
+        if not is_sampling_hours(): return COLLECT_IDLE_SEC
+        return STREAM_REFRESH_SEC if self.stream else COLLECT_SEC
+
+    def sample(self, force=False):
+        """
+        單一飛行: 同一取樣時段 (或手動刷新 MIN_REFRESH_SEC 內) 已有任何行程取過樣，
+        直接沿用快照，不重複打 API、寫歷史或發通知
+        """
+        interval = self.interval()
+        bucket = [interval, int(time_module.time() // interval)]
+        data = None
+        try:
+            with file_lock(SNAPSHOT_FILE):
+                snap = load_snapshot()
+                if snap and not force and snap.get("bucket") == bucket:
+                    data = snap["data"]
+                elif snap and force and time_module.time() - snap.get("ts", 0) < MIN_REFRESH_SEC:
+                    data = snap["data"]
+                else:
+                    data = fetch_all(stream=self.stream, multi=self.multi)
+                    process_alerts(data, *self.tg)
+                    save_snapshot(data, self.owner, bucket)
+            self.err = None
+        except Exception:
+            data = None; self.err = traceback.format_exc()
+        with self.done:
+            if data is not None:
+                self.latest = data; self.ts = time_module.time()
+            self.done.notify_all()
+
+    def run(self):
+        force = False
+        while True:
+            self.sample(force)
+            force = self.wake.wait(self.interval())
+            self.wake.clear()
+
+    def trigger(self):
+        self.wake.set()
+
+    def wait_for(self, since, timeout):
+        """
+        等待 since 之後的新一筆結果
+        """
+        with self.done:
+            self.done.wait_for(lambda: self.ts > since or self.err is not None, timeout=timeout)
+        return self.latest
+
+@st.cache_resource
+def collector_config():
+    """
+    取樣設定 (整個行程共用，不隨瀏覽中的 session 改變)
+    secrets: [collector] stream / multi，[telegram] token / chat_id
+    """
+    try: cfg = dict(st.secrets.get("collector", {}))
+    except: cfg = {}
+    try: tg = (st.secrets["telegram"]["token"], st.secrets["telegram"]["chat_id"])
+    except: tg = (None, None)
+    return bool(cfg.get("stream", False)), bool(cfg.get("multi", False)), tg
+
+@st.cache_resource
+def get_collector():
+    c = Collector()
+    c.stream, c.multi, c.tg = collector_config()
+    c.start()
+    return c
+
+def daemon_snapshot():
+    """
+    獨立 collect 行程仍在運作時，直接讀它的最新結果
+    """
+    snap = load_snapshot()
+    if snap and snap.get("owner") == "daemon" and time_module.time() - snap.get("ts", 0) < 3 * COLLECT_IDLE_SEC:
+        return snap
+    return None
+
+def run_collector():
+    """
+    python streamlit_app.py collect [--stream] [--multi] [--record]
+    """
+    c = Collector(owner="daemon")
+    stream, multi, c.tg = collector_config()
+    c.stream = stream or "--stream" in sys.argv
+    c.multi = multi or "--multi" in sys.argv
+    if "--record" in sys.argv: get_tape().start_record()
+    print(f"取樣中 (串流: {c.stream}，錄製: {get_tape().mode == 'record'})，Ctrl+C 結束")
+    try:
+        while True:
+            c.sample(force=True)
+            if c.latest: print(f"{datetime.now():%H:%M:%S} 廣度 {c.latest['br']:.1%} ({c.latest['h']}/{c.latest['v']}) {c.latest['src_type']}")
+            if c.err: print(c.err)
+            time_module.sleep(c.interval())
+    except KeyboardInterrupt: pass
+    finally: get_tape().stop()
+
 def run_app():
     st.title(f"📈 {APP_VER}")
     
@@ -891,29 +3006,61 @@ def run_app():
         auto = st.checkbox("自動更新", value=False)
         fin_ok = "🟢" if get_finmind_token() else "🔴"
         st.caption(f"FinMind Token: {fin_ok}")
-        tg_tok = st.text_input("TG Token", value=st.secrets.get("telegram",{}).get("token",""), type="password")
-        tg_id = st.text_input("Chat ID", value=st.secrets.get("telegram",{}).get("chat_id",""))
-        if tg_tok and tg_id: st.success("TG Ready")
+        tape = get_tape()
+        rec = st.checkbox("錄製原始回應", value=tape.mode == "record", help=f"MIS / 永豐 / FinMind 回應寫入 {TAPE_DIR}，可用 tape 指令離線重播")
+        if rec and tape.mode != "record": tape.start_record()
+        elif not rec and tape.mode == "record": tape.stop()
+        overlay = st.number_input("疊加前幾日廣度", min_value=0, max_value=CHART_OVERLAY_MAX, value=0, step=1)
         
         st.write("---")
         if st.button("⚡ 強制清除快取 (重抓名單)", type="primary"):
             st.cache_data.clear()
-            if os.path.exists(RANK_FILE): os.remove(RANK_FILE)
+            for f in (RANK_FILE, RANK_LEGACY_FILE):
+                if os.path.exists(f): os.remove(f)
+            if not daemon_snapshot(): get_collector().trigger()
             st.toast("快取已清除，正在重新抓取名單...", icon="🚀")
             time_module.sleep(1)
             st.rerun()
             
         if st.button("🗑️ 重置圖表資料"):
-            if os.path.exists(HIST_FILE):
-                os.remove(HIST_FILE)
+            if os.path.isdir(HIST_DIR):
+                get_history().clear()
                 st.toast("歷史資料已刪除，請重新整理", icon="🗑️")
                 time_module.sleep(1)
             st.rerun()
 
-    if st.button("🔄 刷新"): st.rerun()
+    snap = daemon_snapshot()
+    collector = None if snap else get_collector()
+    stream, multi, tg = (collector.stream, collector.multi, collector.tg) if collector else collector_config()
+    with st.sidebar:
+        st.caption(f"取樣: 串流 {'開' if stream else '關'} / 多族群 {'開' if multi else '關'} / TG {'🟢' if all(tg) else '🔴'}",
+                   help="整個行程共用，由 secrets 的 [collector] stream / multi、[telegram] 或 collect 指令參數設定")
 
+    if st.button("🔄 刷新"):
+        if collector:
+            since = collector.ts
+            collector.trigger()
+            with st.spinner("取樣中..."): collector.wait_for(since, 60)
+        st.rerun()
+
+    stale = None
     try:
-        data = fetch_all()
+        if snap: data = snap["data"]
+        else:
+            data = collector.latest
+            if data is None:
+                # 冷啟動: 先畫上次保存的快照，背景取樣完成後再重跑
+                stale = load_snapshot()
+                if stale: data = stale["data"]
+                else:
+                    with st.spinner("首次取樣中..."): data = collector.wait_for(0, 180)
+                    if data is None and collector.err:
+                        st.error("❌ 首次取樣失敗，將於下次取樣時重試")
+                        with st.expander("錯誤內容", expanded=False): st.text(collector.err)
+                        data = False
+            if collector.err: st.sidebar.caption("⚠️ 上次取樣失敗")
+        if stale:
+            st.sidebar.caption(f"🕒 上次快照 {datetime.fromtimestamp(stale['ts']).strftime('%m/%d %H:%M:%S')}，背景更新中...")
         if isinstance(data, str): st.error(f"❌ {data}")
         elif data:
             st.sidebar.info(f"報價來源: {data['src_type']}")
@@ -925,79 +3072,19 @@ def run_app():
             else:
                 if data['sj_err']: st.sidebar.error(f"🔴 連線失敗: {data['sj_err']}")
                 else: st.sidebar.error("🔴 未連線")
+            if data.get('health') is not None:
+                with st.sidebar.expander("📡 報價來源", expanded=status_code == 1):
+                    st.dataframe(data['health'], use_container_width=True, hide_index=True)
+            if data.get('timing'):
+                with st.sidebar.expander("⏱️ 階段耗時", expanded=False):
+                    st.dataframe(StageMetrics.table(data['timing']), use_container_width=True, hide_index=True)
             
             br = data['br']
-            open_br = get_opening_breadth(data['d'])
-             
-            hist_max, hist_min = get_intraday_extremes(data['d'])
+            n_state = load_notify_state(data['d'])
+            open_br = n_state['open_b'] if n_state['open_b'] is not None else get_opening_breadth(data['d'])
+            hist_max, hist_min = (n_state['max_b'], n_state['min_b']) if n_state['max_b'] is not None else get_intraday_extremes(data['d'])
             today_max = max(hist_max, br) if hist_max is not None else br
             today_min = min(hist_min, br) if hist_min is not None else br
-        
-            n_state = load_notify_state(data['d']) 
-
-            if open_br is not None and n_state['intraday_trend'] is None:
-                if br >= (open_br + 0.05):
-                    n_state['intraday_trend'] = 'up'
-                    if tg_tok and tg_id: send_tg(tg_tok, tg_id, f"🔒 <b>【趨勢鎖定】</b>\n廣度先達開盤+5% (目前{br:.1%})，今日確認偏多！")
-                elif br <= (open_br - 0.05):
-                     n_state['intraday_trend'] = 'down'
-                     if tg_tok and tg_id: send_tg(tg_tok, tg_id, f"🔒 <b>【趨勢鎖定】</b>\n廣度先達開盤-5% (目前{br:.1%})，今日確認偏空！")
-
-            if tg_tok and tg_id:
-                stt = 'normal'
-                if br >= BREADTH_THR: stt = 'hot'
-                elif br <= BREADTH_LOW: stt = 'cold'
-                
-                if stt != n_state['last_stt']:
-                    msg = f"🔥 過熱: {br:.1%}" if stt=='hot' else (f"❄️ 冰點: {br:.1%}" if stt=='cold' else "")
-                    if msg: send_tg(tg_tok, tg_id, msg)
-                
-                n_state['last_stt'] = stt 
-                
-                rap_msg, rid = check_rapid(data['raw'])
-                if rap_msg and rid != n_state['last_rap']:
-                    send_tg(tg_tok, tg_id, rap_msg)
-                    n_state['last_rap'] = rid
-                
-                if open_br is not None:
-                    is_dev_high = (br >= open_br + OPEN_DEV_THR)
-                    is_dev_low = (br <= open_br - OPEN_DEV_THR)
-                
-                    if is_dev_high and not n_state['was_dev_high']:
-                        n_state['was_dev_high'] = True
-                    
-                    if is_dev_low and not n_state['was_dev_low']:
-                        n_state['was_dev_low'] = True
-                
-                    if br <= (today_max - 0.05):
-                        if not n_state['notified_drop_high']:
-                            should_notify = False
-                            if data['slope'] > 0 and n_state['intraday_trend'] == 'up': should_notify = True
-                            if data['slope'] < 0 and n_state['intraday_trend'] == 'up': should_notify = True
-                
-                            if should_notify:
-                                msg = f"📉 <b>【高點回落】</b>\n今日高點: {today_max:.1%}\n目前廣度: {br:.1%}\n已回檔 5%"
-                                send_tg(tg_tok, tg_id, msg)
-                                
-                            n_state['notified_drop_high'] = True
-                    else:
-                        n_state['notified_drop_high'] = False
-                    
-                    if br >= (today_min + 0.05):
-                        if not n_state['notified_rise_low']:
-                            should_notify = False
-                            if data['slope'] < 0 and n_state['intraday_trend'] == 'down': should_notify = True
-                            if data['slope'] > 0 and n_state['intraday_trend'] == 'down': should_notify = True
-                            
-                            if should_notify:
-                                msg = f"🚀 <b>【低點反彈】</b>\n今日低點: {today_min:.1%}\n目前廣度: {br:.1%}\n已反彈 5%"
-                                send_tg(tg_tok, tg_id, msg)
-
-                            n_state['notified_rise_low'] = True
-                    else:
-                        n_state['notified_rise_low'] = False
-            
-                save_notify_state(n_state)
             
             # 將診斷日誌傳入 UI
             display_strategy_panel(data['slope'], open_br, br, n_state, data['chip_strat'], data['chip_diag'])
@@ -1005,8 +3092,18 @@ def run_app():
             st.subheader(f"📅 {data['d']}")
             st.caption(f"名單基準日: {data['d_prev']}") 
             st.info(f"{data['src']} | 更新: {data['t']}")
-            chart = plot_chart()
+            chart = plot_chart(overlay=overlay)
             if chart: st.altair_chart(chart, use_container_width=True)
+
+            with st.expander("⏪ 盤中重播 (1 分 K)", expanded=False):
+                r1, r2 = st.columns([3, 1])
+                rp_d = r1.date_input("日期", value=datetime.strptime(data['d_prev'], "%Y-%m-%d").date())
+                if r2.button("重播"):
+                    with st.spinner("抓取分K中..."):
+                        rp_df, rp_msg = replay_day(get_finmind_token(), rp_d.strftime("%Y-%m-%d"))
+                    st.caption(rp_msg)
+                    if not rp_df.empty:
+                        st.altair_chart(plot_chart(rp_df, rp_d.strftime("%Y-%m-%d")), use_container_width=True)
             
             c1,c2,c3 = st.columns(3)
             c1.metric("今日廣度", f"{br:.1%}", f"{data['h']}/{data['v']}")
@@ -1022,23 +3119,46 @@ def run_app():
             caption_str += f"\n今日目前最低廣度: {today_min:.1%}"
             
             c1.caption(caption_str)
+            live = get_quote_book().state if stream and collector else None
+            if live is not None and live.v:
+                c1.caption(f"⚡ 串流即時廣度: {live.h / live.v:.1%} ({live.h}/{live.v})")
             
             c2.metric("大盤漲跌", f"{data['tc']:.2%}")
             sl = data['slope']; icon = "📈 正" if sl > 0 else "📉 負"
             c3.metric("大盤MA5斜率", f"{sl:.2f}", icon)
             
+            if data.get('uni') is not None:
+                with st.expander("🧭 多族群廣度", expanded=False):
+                    st.dataframe(data['uni'], use_container_width=True, hide_index=True,
+                                 column_config={"廣度": st.column_config.ProgressColumn("廣度", format="%.2f", min_value=0, max_value=1)})
+
             st.dataframe(data['df'], use_container_width=True, hide_index=True)
-        else: st.sidebar.warning("⏸ 休市")
+
+            with st.expander("🧪 策略回測", expanded=False):
+                b1, b2, b3 = st.columns(3)
+                bt_open = b1.number_input("趨勢鎖定門檻", value=OPEN_DEV_THR, step=0.01, format="%.2f")
+                bt_swing = b2.number_input("回落/反彈門檻", value=SWING_THR, step=0.01, format="%.2f")
+                bt_start = b3.text_input("起始日", value="2000-01-01")
+                if st.button("執行回測"):
+                    summary, trades = run_backtest(load_history_frame(bt_start), get_hist(get_finmind_token(), "TAIEX", bt_start), bt_open, bt_swing)
+                    st.dataframe(summary, use_container_width=True, hide_index=True)
+                    st.dataframe(trades, use_container_width=True, hide_index=True)
+        elif data is None: st.sidebar.warning("⏸ 休市")
 
     except Exception as e: 
         st.error(f"Error: {e}")
         st.text(traceback.format_exc())
 
+    if stale:
+        # 背景首筆取樣完成前短暫等待後重跑，側欄操作最多延遲 COLD_POLL_SEC 秒
+        # 取樣失敗時 wait_for 會立即返回，改為固定等待，避免無間隔重跑
+        if collector.err: time_module.sleep(COLD_POLL_SEC)
+        else: collector.wait_for(0, COLD_POLL_SEC)
+        st.rerun()
+
     if auto:
-        now = datetime.now(timezone(timedelta(hours=8)))
-        is_intra = (time(8,45)<=now.time()<time(13,30)) and (0<=now.weekday()<=4)
-        if is_intra:
-            sec = 120
+        if is_sampling_hours():
+            sec = STREAM_REFRESH_SEC if stream else 120
             with st.sidebar:
                 t = st.empty()
                 for i in range(sec, 0, -1):
@@ -1056,7 +3176,15 @@ if __name__ == "__main__":
         except:
             pass
 
-    if 'streamlit' in sys.modules and any('streamlit' in arg for arg in sys.argv):
+    if len(sys.argv) > 1 and sys.argv[1] == "collect":
+        run_collector()
+    elif len(sys.argv) > 1 and sys.argv[1] == "backtest":
+        run_backtest_cli()
+    elif len(sys.argv) > 1 and sys.argv[1] == "backfill":
+        run_backfill_cli()
+    elif len(sys.argv) > 1 and sys.argv[1] == "tape":
+        run_tape_cli()
+    elif 'streamlit' in sys.modules and any('streamlit' in arg for arg in sys.argv):
         run_app()
     else:
         print("正在啟動 Streamlit 介面 (介面優化版)...")